@@ -1,4 +1,7 @@
 import logging
+from tornado import gen
+from tornado.ioloop import IOLoop
+import APIs.dispatch as dispatch
 
 
 class BaseAPIHandler:
@@ -27,34 +30,100 @@ class BaseAPIHandler:
     def handle(self, msgid, msgtype, data, client, user=None):
         '''
         Find the right handler and distribute the incoming message to there.
+        Handlers that are coroutines or declared blocking do not respond
+        right away, for those a Future of the response is returned.
 
         :param msgid: Message ID
         :param msgtype: Message Type
         :param data: Data
         :param client: Client
         :param user: User
-        :return: None
+        :return: Response, or Future of the response
         '''
         try:
             func = self.message_handlers[msgtype]
-            try:
-                return func(client, msgid, data, user)
-            except KeyError as e:
-                logging.exception('Keyerror inside function:', e.args[0])
-                return (self.name, None, 'error',
-                        {'msg': 'Missing parameter "' + str(e.args[0]) + '"'},
-                        msgid)
-            except TypeError as e:
-                logging.exception('TypeError inside function: ' + str(e))
-                return (self.name, None, 'error',
-                        {'msg': 'Invalid command syntax'},
-                        msgid)
-            except AttributeError as e:
-                logging.exception('AttributeError inside function: ' + str(e))
-                return (self.name, None, 'error',
-                        {'msg': 'Invalid command syntax'},
-                        msgid)
         except KeyError:
             logging.error('Unknown messagetype %s' % msgtype)
             return (self.name, None, 'error', {'msg': 'Unknown messagetype'},
                     msgid)
+
+        if dispatch.is_async(func):
+            return self.handle_async(func, msgid, msgtype, data, client, user)
+        return self.handle_sync(func, msgid, data, client, user)
+
+    def handle_sync(self, func, msgid, data, client, user):
+        '''
+        Handle a message with a handler that responds right away.
+
+        :param func: Message handler
+        :param msgid: Message ID
+        :param data: Data
+        :param client: Client
+        :param user: User
+        :return: Response
+        '''
+        try:
+            return func(client, msgid, data, user)
+        except (KeyError, TypeError, AttributeError) as e:
+            return self.error_response(msgid, e)
+
+    @gen.coroutine
+    def handle_async(self, func, msgid, msgtype, data, client, user):
+        '''
+        Handle a message with a coroutine or blocking handler, within the
+        concurrency limit and timeout of its message type.
+
+        :param func: Message handler
+        :param msgid: Message ID
+        :param msgtype: Message Type
+        :param data: Data
+        :param client: Client
+        :param user: User
+        :return: Future of the response
+        '''
+        limit = dispatch.limit_for(self.name, msgtype)
+        deadline = IOLoop.current().time() + limit.timeout
+        try:
+            yield limit.semaphore.acquire(timeout=deadline)
+        except gen.TimeoutError:
+            raise gen.Return(self.timeout_response(msgid, msgtype))
+
+        if dispatch.is_blocking(func):
+            future = dispatch.get_executor().submit(func, client, msgid, data,
+                                                    user)
+        else:
+            future = func(client, msgid, data, user)
+        # The handler keeps its place until it is really done, also if the
+        # client got a timeout error already
+        future.add_done_callback(lambda f: limit.semaphore.release())
+        try:
+            response = yield gen.with_timeout(deadline, future)
+        except gen.TimeoutError:
+            response = self.timeout_response(msgid, msgtype)
+        except (KeyError, TypeError, AttributeError) as e:
+            response = self.error_response(msgid, e)
+        raise gen.Return(response)
+
+    def error_response(self, msgid, e):
+        '''
+        Create the response to an error raised by a message handler.
+
+        :param msgid: Message ID
+        :param e: Exception
+        :return: Response
+        '''
+        if isinstance(e, KeyError):
+            logging.exception('Keyerror inside function: ' + str(e.args[0]))
+            return (self.name, None, 'error',
+                    {'msg': 'Missing parameter "' + str(e.args[0]) + '"'},
+                    msgid)
+        logging.exception('%s inside function: ' % type(e).__name__ + str(e))
+        return (self.name, None, 'error',
+                {'msg': 'Invalid command syntax'},
+                msgid)
+
+    def timeout_response(self, msgid, msgtype):
+        logging.warning('Timeout handling %s' % msgtype)
+        return (self.name, None, 'error',
+                {'msg': 'Timeout handling "' + msgtype + '"'},
+                msgid)
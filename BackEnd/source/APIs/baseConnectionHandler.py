@@ -1,20 +1,61 @@
 import logging
-import json
 import client
-import re
 import tornado
+import tornado.concurrent
+from tornado import gen
 import tornado.ioloop
-import pprint
-import datetime
+import functools
+import time
 from config_handler import config, prefs
+import delivery
+import heartbeat
+import outbound
+import ratelimit
+import serialization
+from envelope import EncodedMessage
+from message_log import MessageLogger
 from APIs.control.controlHandler import ControlAPIHandler
+from APIs.routes import RouteTable
+import metrics
 handlers = {'control': ControlAPIHandler()}
-
-regex_split_json_packets = re.compile('}\s*{')
+# Every (handler, command) of the API handlers, with their counters
+routes = RouteTable(handlers)
+metrics.register(routes)
+message_log = MessageLogger(
+    sample_every=config.getint('server', 'message_log_sample'))
+
+
+class InboundCounters:
+    '''
+    Counts the inbound frames and messages dropped by the limits of the
+    [inbound] section, over all channels.
+    '''
+    def __init__(self):
+        self.throttled_messages = 0
+        self.throttled_frames = 0
+        self.oversized_frames = 0
+
+    def collect(self, writer):
+        writer.header('iot_inbound_dropped_total', 'counter',
+                      'Inbound messages and frames dropped by the limits')
+        writer.sample('iot_inbound_dropped_total',
+                      [('reason', 'throttled_message')],
+                      self.throttled_messages)
+        writer.sample('iot_inbound_dropped_total',
+                      [('reason', 'throttled_frame')], self.throttled_frames)
+        writer.sample('iot_inbound_dropped_total',
+                      [('reason', 'oversized_frame')], self.oversized_frames)
+
+
+inbound_counters = InboundCounters()
+metrics.register(inbound_counters)
 
 
 class BaseConnectionHandler:
-    prev_id = 1000
+    # Codec of the channel, replaced if another one is negotiated
+    codec = serialization.default_codec
+    # CompressionStats, if the channel counts its compression
+    compression_stats = None
 
     def setup(self):
         self.ip = None
@@ -22,24 +63,134 @@ class BaseConnectionHandler:
         self.id = None
         self.channeltype = None
         self.remote_host = None
+        self.decoder = self.codec.decoder(
+            config.getint('inbound', 'max_message_size'))
+        # Inbound limits, see admit_frame and admit_message
+        self.max_frame_size = config.getint('inbound', 'max_frame_size')
+        self.inbound_bucket = ratelimit.create_bucket(config, 'inbound',
+                                                      'channel', time.time())
+        self.throttled_until = 0
+        self.inbound_stats = {'throttled_messages': 0, 'throttled_frames': 0,
+                              'oversized_frames': 0}
+        # Messages waiting to be flushed to the network
+        self.outbound = outbound.create_queue(config, self.write_frame,
+                                              self.disconnect)
+        # Whether the client acknowledges the messages sent to it, and gets
+        # a response or acknowledgement to every message it sends. Set with
+        # 'reliable' in the setchannelmode command
+        self.reliable = False
+        self.delivery = delivery.create_window(config, self.outbound.put)
+        # Round trip time measured with the keep-alive pings
+        self.rtt = heartbeat.RoundTripTime()
         self.ioloop = tornado.ioloop.IOLoop.instance()
 
     def on_message(self, message):
         '''
-        Handle an incoming message on the websocket. Extract message ID and
-        message class, and then call the appropriate message handler. If a
-        response is given,  this to the caller or to the specified
-        receiver(s).
+        Handle an incoming message on the websocket. A frame may hold several
+        messages stacked together, each of them is handled in order.
 
         :param message: Message received
         :return: None
         '''
         try:
-            message = self.unpack_json(message)
-            if message is None:
-                # Either malformed JSON or stacked and handled separately
+            now = time.time()
+            if not self.admit_frame(message, now):
                 return
+            for unpacked_json in self.unpack_json(message):
+                if not self.admit_message(unpacked_json, now):
+                    # Drop the rest of the frame
+                    self.decoder.reset()
+                    return
+                self.handle_message(unpacked_json)
+        except tornado.websocket.WebSocketClosedError:
+            # Channel closed while the frame was handled
+            pass
+        except OSError as e:
+            if e.errno == 9:
+                pass
+            else:
+                logging.exception("Uncaught and unhandled internal error: " +
+                                  str(type(e)) + ': ' + str(e))
+        except Exception as e:
+            logging.exception("Uncaught and unhandled internal error: " +
+                              str(type(e)) + ': ' + str(e))
 
+    def admit_frame(self, message, now):
+        '''
+        Check a frame against the limits of the [inbound] section before it
+        is decoded. Frames of a throttled channel are dropped right away, and
+        so are frames larger than max_frame_size. Tornado closes the
+        connection already for larger frames on the wire, this catches
+        frames that only grew that large when decompressed.
+
+        :param message: Frame received
+        :param now: Current time in seconds
+        :return: True if the frame may be decoded
+        '''
+        if now < self.throttled_until:
+            self.inbound_stats['throttled_frames'] += 1
+            inbound_counters.throttled_frames += 1
+            return False
+        if len(message) > self.max_frame_size:
+            self.inbound_stats['oversized_frames'] += 1
+            inbound_counters.oversized_frames += 1
+            logging.warning('Client %s, channel %d: ' % (self.ip, self.id) +
+                            'Frame of %d bytes dropped' % len(message))
+            self.decoder.reset()
+            self.send('handler_unidentifiable', 'error',
+                      {'msg': 'Frame larger than %d bytes' %
+                              self.max_frame_size}, -1)
+            return False
+        return True
+
+    def admit_message(self, message, now):
+        '''
+        Take a token for a message from the bucket of the channel and the
+        bucket shared by all connections of the client. Acknowledgements are
+        not limited, dropping them would only cause retransmissions. Without
+        tokens the channel is throttled until there are, and the client gets
+        one error telling when to retry.
+
+        :param message: Unpacked message
+        :param now: Current time in seconds
+        :return: True if the message may be handled
+        '''
+        if isinstance(message, dict) and message.get('command') == 'ack':
+            return True
+        wait = self.inbound_bucket.take(now)
+        if not wait and self.client is not None and \
+                self.client.inbound_bucket is not None:
+            wait = self.client.inbound_bucket.take(now)
+            if wait:
+                # Not this channel's fault, give its token back
+                self.inbound_bucket.tokens += 1
+        if not wait:
+            return True
+        self.throttled_until = now + wait
+        self.inbound_stats['throttled_messages'] += 1
+        inbound_counters.throttled_messages += 1
+        logging.warning('Client %s, channel %d: ' % (self.ip, self.id) +
+                        'Too many messages, throttled for %.3f s' % wait)
+        try:
+            respond_id = int(message['msgid'])
+        except (KeyError, TypeError, ValueError):
+            respond_id = -1
+        self.send('handler_unidentifiable', 'error',
+                  {'msg': 'Too many messages',
+                   'retry_after': round(wait, 3)},
+                  respond_id)
+        return False
+
+    def handle_message(self, message):
+        '''
+        Handle a single unpacked message. Extract message ID and message class,
+        and then call the appropriate message handler. If a response is given,
+        this to the caller or to the specified receiver(s).
+
+        :param message: Message unpacked into a Python dict
+        :return: None
+        '''
+        try:
             unpacked = self.unpack_message(message)
             if unpacked is None:
                 # Invalid data in message, already handled
@@ -62,45 +213,24 @@ class BaseConnectionHandler:
 
     def unpack_json(self, message):
         '''
-        Try to unpack the message into a Python dict. If it fails, first check
-        whether this is because several packets are stacked together. If not,
-        reply with an error message to the client.
-
-        :param message: Message to unpack in JSON format
-        :return: Message unpacked
+        Unpack the frame into Python dicts. Several packets may be stacked
+        together in one frame and a packet may continue in the next frame, so
+        the frame is fed to the streaming decoder of the channel's codec.
+        Reply with an error message to the client for every malformed packet.
+
+        :param message: Frame to unpack, JSON unless another codec was
+         negotiated
+        :return: Generator of unpacked messages
         '''
-        try:
-            message = json.loads(message)
-            return message
-        except ValueError:
-            # Try if stacked request
-            messages = regex_split_json_packets.split(message)
-            if len(messages) > 1:
-                # Remove trailing '{' and '}' from resp. first and last elem
-                messages[0] = messages[0].strip()[1:]
-                messages[-1] = messages[-1].strip()[:-1]
-
-                compiled_message = ''
-                for msg in messages:
-                    # Reconstruct message after previous split
-
-                    compiled_message += '{' + msg + '}'
-
-                    # Check if count of " characters is equal. If not, it is
-                    # part of a data field and the message should not be split
-                    # here.
-                    if compiled_message.count('"') % 2 == 0:
-                        # Split message complete, call with separate
-                        self.on_message(compiled_message)
-                        compiled_message = ''
-                return
-
-            logging.warning('Client %s, channel %d: ' % (self.ip, self.id) +
-                            'Malformed JSON packet received')
-            self.send('handler_unidentifyable', 'error',
-                      {'msg': 'Malformed JSON packet received'},
-                      -1)
-            return
+        for unpacked_json in self.decoder.feed(message):
+            if unpacked_json is None:
+                error = 'Malformed %s packet received' % self.codec.name.upper()
+                logging.warning('Client %s, channel %d: ' % (self.ip, self.id) +
+                                error)
+                self.send('handler_unidentifyable', 'error', {'msg': error},
+                          -1)
+                continue
+            yield unpacked_json
 
     def unpack_message(self, message):
         '''
@@ -147,72 +277,147 @@ class BaseConnectionHandler:
         :param message: message
         :return: None
         '''
-        logging.info(
-            '%s | Receiving from %s - msgid: %d, handler: %s, command: %s | %s'
-            % (str(datetime.datetime.now()), self.ip, msgid, handler, msgtype,
-               str(self)))
-        ppdata = pprint.pformat(data)
-        logging.debug(
-            '>>>Receiving<<<\n' +
-            '\tsender:\t\t%s\n' % self.ip +
-            '\tchannelid:\t%d\n' % self.id +
-            '\thandler:\t%s\n\tmessage id:\t%d\n' % (handler, msgid) +
-            '\tmessagetype:\t%s\n' % (msgtype) +
-            '\t=============================================\n'
-            '\t%s\n' % str(ppdata) +
-            '\t=============================================')
+        message_log.received(self.ip, self.id, handler, msgid, msgtype, data)
         # Determine what to do with this message
-        if handler == 'channel':
+        if msgtype == 'ack':
+            # Acknowledgement of a message sent on a reliable channel
+            self.delivery.acknowledge(msgid)
+        elif handler == 'channel':
             self.handle_channel_command(msgtype, msgid, data)
+        elif handler == 'batch':
+            self.handle_batch(msgtype, msgid, data)
         else:
             # 'Normal' message, find correct handler and handle responses
             # Check if optional user parameter provided in message
             user = None
 
             # Execute message handler, if any. Otherwise request is malformed
-            try:
-                response = handlers[handler].handle(msgid, msgtype, data,
-                                                    self.client, user)
-            except KeyError as e:
-                logging.error('Unknown handler %s' % handler)
-                self.send(handler, 'error',
-                          {'msg': 'Unknown handler "' + e.args[0] + '"'},
-                          msgid)
+            route = routes.get(handler, msgtype)
+            if route is None:
+                self.send_unknown_route(handler, msgtype, msgid)
                 return
-            if response is not None:
-                r_channel, r_receivers, r_msgtype, r_message, \
-                    r_respondID = response
+            response = route.handle(msgid, data, self.client, user)
+            if tornado.concurrent.is_future(response):
+                self.ioloop.add_future(
+                    response,
+                    functools.partial(self.on_response_ready, handler, msgid))
+            else:
+                self.handle_response(handler, msgid, response)
+
+    def send_unknown_route(self, handler, msgtype, msgid):
+        '''
+        Respond to a message for which there is no route.
+
+        :param handler: API handler. e.g. 'control'
+        :param msgtype: Type of message request
+        :param msgid: Id of message
+        :return: None
+        '''
+        error = routes.unknown_route_error(handler)
+        logging.error('%s: %s' % (error, msgtype))
+        self.send(handler, 'error', {'msg': error}, msgid)
+
+    def on_response_ready(self, handler, msgid, future):
+        '''
+        Handle the response of a coroutine or blocking message handler once it
+        is done.
+
+        :param handler: API handler. e.g. 'control'
+        :param msgid: Id of message
+        :param future: Future of the response
+        :return: None
+        '''
+        try:
+            self.handle_response(handler, msgid, future.result())
+        except tornado.websocket.WebSocketClosedError:
+            # Channel closed while the message was handled
+            pass
+        except Exception as e:
+            logging.exception("Uncaught and unhandled internal error: " +
+                              str(type(e)) + ': ' + str(e))
+
+    def handle_response(self, handler, msgid, response):
+        '''
+        Send the response of a message handler to the current client or to
+        the specified receiver(s).
 
-                if r_receivers is None:
-                    # Response just goes current client
+        :param handler: API handler. e.g. 'control'
+        :param msgid: Id of message
+        :param response: Response tuple of the message handler, or None
+        :return: None
+        '''
+        if response is not None:
+            r_channel, r_receivers, r_msgtype, r_message, \
+                r_respondID = response
+
+            if r_receivers is None:
+                # Response just goes current client
+                if isinstance(r_message, EncodedMessage):
+                    # Cached snapshot, encoded already
+                    self.send_self_encoded(r_message, r_respondID)
+                else:
                     self.send_self(r_channel, r_msgtype, r_message,
                                    r_respondID)
-                elif len(r_receivers) > 0:
-                    # Find the appropriate channel for all receivers
-                    for r in r_receivers:
-                        if r.ws == self:
-                            logging.info("Sending through self channel: " +
-                                         str(self))
-                            self.send_self(r_channel, r_msgtype, r_message,
-                                           r_respondID)
-                        else:
-                            channel = r.get_channel(r_channel)
-                            logging.info("Sending through channel: " +
-                                         str(channel))
-                            if channel is not None:
-                                # Add to waiting for acknowledgements list
-                                if r_respondID is None:
-                                    r_respondID = channel.generate_id()
-
-                                channel.send(r_channel, r_msgtype, r_message,
-                                             r_respondID)
-                else:
-                    # Empty list of receivers equals no responses
+            elif len(r_receivers) > 0:
+                self.broadcast(r_receivers, r_channel, r_msgtype,
+                               r_message, r_respondID)
+                if self.reliable:
+                    # A reliable client keeps what it sent until it gets a
+                    # response, so it is acknowledged also when the response
+                    # only went to others
                     self.send_ack(msgid, handler)
             else:
-                # No explicit response and no effect for other clients, send
-                # acknowledgement right away
+                # Empty list of receivers equals no responses
                 self.send_ack(msgid, handler)
+        else:
+            # No explicit response and no effect for other clients, send
+            # acknowledgement right away
+            self.send_ack(msgid, handler)
+
+    @gen.coroutine
+    def handle_batch(self, msgtype, msgid, data):
+        '''
+        Handle a batch of commands, given as a list of dicts with 'handler',
+        'command', 'data' and optionally 'msgid'. The commands are handled in
+        order and answered with one 'results' message, holding the response
+        or acknowledgement of every command in the same order.
+
+        :param msgtype: Message type
+        :param msgid: Message Id
+        :param data: List of commands
+        :return: None
+        '''
+        try:
+            if msgtype != 'batch':
+                self.send('batch', 'error',
+                          {'msg': 'Unsupported messagetype "' + msgtype + '"'},
+                          msgid)
+                return
+            if not isinstance(data, list):
+                self.send('batch', 'error',
+                          {'msg': 'Batch data must be a list of commands'},
+                          msgid)
+                return
+            max_commands = config.getint('server', 'max_batch_commands')
+            if len(data) > max_commands:
+                self.send('batch', 'error',
+                          {'msg': 'Batch holds more than %d commands' %
+                                  max_commands},
+                          msgid)
+                return
+
+            results = []
+            for command in data:
+                result = yield routes.run_command(command, msgid,
+                                                  self.client, self.broadcast)
+                results.append(result)
+            self.send('batch', 'results', results, msgid)
+        except tornado.websocket.WebSocketClosedError:
+            # Channel closed while the batch was handled
+            pass
+        except Exception as e:
+            logging.exception("Uncaught and unhandled internal error: " +
+                              str(type(e)) + ': ' + str(e))
 
     def send_ack(self, respond_id, handler=None):
         '''
@@ -226,6 +431,31 @@ class BaseConnectionHandler:
             handler = self.channeltype
         self.send(handler, 'ack', None, respond_id)
 
+    def broadcast(self, receivers, handler, msgtype, message,
+                  respond_id=None):
+        '''
+        Send a message to several clients. The message is encoded once and the
+        encoded body is reused for the channel of every receiver, only the
+        message id is added per receiver.
+
+        :param receivers: List of clients
+        :param handler: Handler, also the type of channel to send through
+        :param msgtype: Message type
+        :param message: Message
+        :param respond_id: Message Id. If None, every channel generates its own
+        :return: None
+        '''
+        encoded = EncodedMessage(handler, msgtype, message)
+        for r in receivers:
+            if r.ws == self:
+                logging.debug("Sending through self channel: %s", self)
+                self.send_self_encoded(encoded, respond_id)
+            else:
+                channel = r.get_channel(handler)
+                logging.debug("Sending through channel: %s", channel)
+                if channel is not None:
+                    channel.send_encoded(encoded, respond_id)
+
     def send_self(self, handler, msgtype, message, respond_id=None):
         '''
         Send a message to this client, by checking whether this is the
@@ -237,12 +467,24 @@ class BaseConnectionHandler:
         :param respond_id: Message Id
         :return: None
         '''
-        if self.channeltype is None or self.channeltype == handler:
-            self.send(handler, msgtype, message, respond_id)
+        self.send_self_encoded(EncodedMessage(handler, msgtype, message),
+                               respond_id)
+
+    def send_self_encoded(self, encoded, respond_id=None):
+        '''
+        Send an already encoded message to this client, by checking whether
+        this is the appropriate channel or finding another one.
+
+        :param encoded: EncodedMessage
+        :param respond_id: Message Id
+        :return: None
+        '''
+        if self.channeltype is None or self.channeltype == encoded.handler:
+            self.send_encoded(encoded, respond_id)
         else:
-            channel = self.client.get_channel(handler)
+            channel = self.client.get_channel(encoded.handler)
             if channel is not None:
-                channel.send(handler, msgtype, message, respond_id)
+                channel.send_encoded(encoded, respond_id)
             else:
                 self.send(self.channeltype, 'error',
                           {'msg': 'No channel available for response'},
@@ -258,32 +500,49 @@ class BaseConnectionHandler:
         :param respond_id: Message Id
         :return: None
         '''
+        self.send_encoded(EncodedMessage(handler, msgtype, message),
+                          respond_id)
+
+    def send_encoded(self, encoded, respond_id=None):
+        '''
+        Send an already encoded message on this channel. If the channel is
+        reliable, a message that is not a response is tracked until the
+        client acknowledges it.
+
+        :param encoded: EncodedMessage
+        :param respond_id: Message Id
+        :return: None
+        '''
+        tracked = False
         if respond_id is None:
             respond_id = self.generate_id()
+            tracked = self.reliable
+
+        message_log.sent(self.ip, self.id, encoded.handler, respond_id,
+                         encoded.msgtype, encoded.data)
+        message = encoded.for_msgid(respond_id, self.codec)
+        if tracked:
+            self.delivery.send(respond_id, encoded.handler, encoded.msgtype,
+                               message)
+        else:
+            self.outbound.put(encoded.handler, encoded.msgtype, message)
+
+    def write_frame(self, message):
+        '''
+        Write an encoded message to the connection.
+
+        :param message: Encoded message
+        :return: Future that is done when the message is flushed, or None
+        '''
+        return self.write_message(message, binary=self.codec.binary)
 
-        message = {
-            'msgid': respond_id,
-            'handler': handler,
-            'command': msgtype,
-            'data': message
-        }
-
-        logging.info(
-            '%s | Sending to %s - msgid: %s, handler: %s, command: %s' %
-            (str(datetime.datetime.now()),
-             self.ip, respond_id, handler, msgtype))
-        ppmessage = pprint.pformat(message)
-        logging.debug(
-            '>>>Sending<<<\n' +
-            '\treceiver:\t\t%s\n' % self.ip +
-            '\tchannelid:\t%d\n' % self.id +
-            '\thandler:\t%s\n\tmessage id:\t%d\n' % (handler, respond_id) +
-            '\tmessagetype:\t%s\n' % (msgtype) +
-            '\t=============================================\n'
-            '\t%s\n' % str(ppmessage) +
-            '\t=============================================')
-
-        self.write_message(json.dumps(message))
+    def disconnect(self):
+        '''
+        Close the connection of this channel.
+
+        :return: None
+        '''
+        self.close()
 
     def handle_channel_command(self, msgtype, msgid, data):
         '''
@@ -310,6 +569,8 @@ class BaseConnectionHandler:
                 return
             if 'clientname' in data:
                 self.client.set_name(data['clientname'])
+            if data.get('reliable') in ['True', 'true', True]:
+                self.reliable = True
         self.send_ack(msgid, 'channel')
 
     def on_close(self):
@@ -326,16 +587,42 @@ class BaseConnectionHandler:
             self.client.remove_channel(self.id)
             logging.info('Connection to %s on %s closed' %
                          (self.client.name, self.ip))
-        ppdata = pprint.pformat([{c.ws: (c.ip, c.host)}
-                                 for c in client.clients.values()])
-        logging.info("Current clients after deletion==================")
-        logging.info(ppdata)
+        elif self.client is not None and not self.client.channels:
+            # Refused before it got a channel, do not leave the client behind
+            client.clients.release(self.client)
+        lost = self.delivery.clear()
+        if lost > 0:
+            logging.warning('%d messages to %s, channel %d ' %
+                            (lost, self.ip, self.id) +
+                            'were not acknowledged before closing')
+        self.outbound.clear()
+        if self.compression_stats is not None:
+            logging.info('Compression of channel %d: %s' %
+                         (self.id, self.compression_stats.as_dict()))
+        client.log_clients("Current clients after deletion==================")
+
+    def get_stats(self):
+        '''
+        Get the counters of this channel.
+
+        :return: Dict with the counters
+        '''
+        stats = {'id': self.id,
+                 'type': self.channeltype,
+                 'outbound': self.outbound.as_dict(),
+                 'rtt': self.rtt.as_dict()}
+        if self.reliable:
+            stats['delivery'] = self.delivery.as_dict()
+        if self.compression_stats is not None:
+            stats['compression'] = self.compression_stats.as_dict()
+        stats['inbound'] = dict(self.inbound_stats)
+        return stats
 
     def generate_id(self):
         '''
-        Generate a message ID to use. Yield sequence from 1000-9999
+        Generate a message ID to use. Ids are unique within the process, see
+        delivery.next_id
 
         :return: Id
         '''
-        self.prev_id = ((self.prev_id - 999) % 9000) + 1000
-        return self.prev_id
+        return delivery.next_id()
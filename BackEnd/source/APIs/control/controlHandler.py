@@ -8,6 +8,12 @@ class ControlAPIHandler(BaseAPIHandler):
                             systemAPI.handle_list_available_clients,
                         'list_available_bags':
                             systemAPI.handle_list_available_bags,
+                        'client_stats':
+                            systemAPI.handle_client_stats,
+                        'subscribe_presence':
+                            systemAPI.handle_subscribe_presence,
+                        'unsubscribe_presence':
+                            systemAPI.handle_unsubscribe_presence,
                         'report_missing_item':
                             systemAPI.handle_report_missing_item,
                         'set_tracking_place':
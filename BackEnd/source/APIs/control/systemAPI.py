@@ -1,49 +1,130 @@
 import logging
+import os
 import client as client_module
+import cluster
+import presence
+from tornado import gen
+from envelope import EncodedMessage
 
-def handle_list_available_clients(client, msgid, msg, user):
+class ListingCache:
     '''
-    Send a list of currently available clients in the system. A client is
-    considered active if it has one or more active channels associated with it.
+    Encoded client listings. A listing is only built and encoded again when
+    the client registry changed since, so repeated polls cost a lookup. Each
+    listing carries an ETag made of the registry version and the number of
+    builds. Round trip times change with every ping, so they are not part of
+    the cached listings, see listing_response.
     '''
+    def __init__(self):
+        self.builds = 0
+        # (registry version, EncodedMessage) per listing name
+        self.entries = {}
+
+    def get(self, name, build):
+        '''
+        Get a listing, building it if the registry changed.
+
+        :param name: Name of the listing
+        :param build: Function returning the listing data
+        :return: EncodedMessage
+        '''
+        version = client_module.clients.version
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != version:
+            self.builds += 1
+            encoded = EncodedMessage(
+                'control', 'available_clients', build(),
+                etag='"%d-%d-%d"' % (os.getpid(), version, self.builds))
+            entry = (version, encoded)
+            self.entries[name] = entry
+        return entry[1]
+
+
+listing_cache = ListingCache()
+
+
+def list_clients(targets, with_rtt=False):
     data = {'clients': []}
-    for target in client_module.clients.values():
+    for target in targets:
         if len(target.channels) != 0:
             elem = {'ip': target.ip,
                     'name': target.name,
                     'host': target.host,
                     'trusted_ip': target.from_trusted_ip,
-                    'id': target.id}
+                    'id': target.id,
+                    'channels': target.get_channel_list(with_rtt)}
 
             data['clients'].append(elem)
-    return ('control', None, 'available_clients', data, msgid)
+    return data
+
+
+def listing_response(name, targets, msgid, msg):
+    '''
+    Respond with a listing. The cached one, unless the message asks for the
+    round trip times of the channels with 'rtt'. Those change with every
+    ping, so that listing is built for this response only.
+
+    :param name: Name of the listing
+    :param targets: Function returning the clients to list
+    :param msgid: Message ID
+    :param msg: Message data
+    :return: Response
+    '''
+    if isinstance(msg, dict) and msg.get('rtt') in ['True', 'true', True]:
+        return ('control', None, 'available_clients',
+                list_clients(targets(), True), msgid)
+    listing = listing_cache.get(name, lambda: list_clients(targets()))
+    return ('control', None, 'available_clients', listing, msgid)
+
+
+def handle_list_available_clients(client, msgid, msg, user):
+    '''
+    Send a list of currently available clients in the system. A client is
+    considered active if it has one or more active channels associated with it.
+    '''
+    return listing_response('clients', client_module.clients.values, msgid,
+                            msg)
 
 def handle_list_available_bags(client, msgid, msg, user):
     '''
     Send a list of currently available bags in the system. A bag is
     considered active if it has one or more active channels associated with it.
     '''
-    data = {'clients': []}
-    for target in client_module.clients.values():
-        if len(target.channels) != 0 and 'SB' in target.name:
-            elem = {'ip': target.ip,
-                    'name': target.name,
-                    'host': target.host,
-                    'trusted_ip': target.from_trusted_ip,
-                    'id': target.id}
+    return listing_response(
+        'bags',
+        lambda: client_module.find_clients_by_kind(client_module.KIND_BAG),
+        msgid, msg)
 
-            data['clients'].append(elem)
-    return ('control', None, 'available_clients', data, msgid)
+def handle_client_stats(client, msgid, msg, user):
+    '''
+    Send the counters of the channels of a client. These change with every
+    message, so unlike the listings they are not cached.
+    '''
+    target = client_module.find_client(msg['target'])
+    if target is None:
+        return ('control', None, 'error', {'msg': 'no such client'}, msgid)
+    data = {'ip': target.ip,
+            'name': target.name,
+            'channels': target.get_stats()}
+    return ('control', None, 'client_stats', data, msgid)
 
-def handle_report_missing_item(client, msgid, message, user):
-    receivers = []
-    if 'target' in message:
-        target = client_module.find_client(message['target'])
-        if target is None:
-            return ('control', None, 'error',
-                    {'msg': 'no such client'}, msgid)
-        receivers.append(target)
+def handle_subscribe_presence(client, msgid, msg, user):
+    '''
+    Subscribe to presence events. The subscriber gets a snapshot of the
+    available clients now, and a 'presence' message with a join, leave or
+    rename event for every change after that.
+    '''
+    if client is None:
+        return ('control', None, 'error',
+                {'msg': 'Presence needs a websocket connection'}, msgid)
+    data = presence.hub.subscribe(client)
+    return ('control', None, 'presence_snapshot', data, msgid)
 
+def handle_unsubscribe_presence(client, msgid, msg, user):
+    if client is not None:
+        presence.hub.unsubscribe(client)
+    return
+
+def handle_report_missing_item(client, msgid, message, user):
     data = dict()
     if client is not None:
         data['sender'] = client.ip
@@ -53,23 +134,56 @@ def handle_report_missing_item(client, msgid, message, user):
         data['line2'] = message['line2']
     if 'is_error' in message:
         data['is_error'] = message['is_error']
+    if 'repeat' in message:
+        # Number of identical alerts the bag merged into this one
+        data['repeat'] = message['repeat']
 
-    return ('control', receivers, 'print_message', data, None)
+    return route_to_target(message, 'print_message', data, msgid)
 
 
 def handle_set_tracking_place(client, msgid, message, user):
+    data = dict()
+    data['tags'] = message['tags']
+
+    return route_to_target(message, 'track_articles', data, msgid)
+
+
+def route_to_target(message, msgtype, data, msgid):
+    '''
+    Build the response that sends data to the client in the 'target' field of
+    the message. If that client is not connected to this worker process, the
+    data is routed to the other workers. The sender gets an acknowledgement
+    once one of them delivered it, or an error if none holds the client.
+    '''
     receivers = []
     if 'target' in message:
         target = client_module.find_client(message['target'])
         if target is None:
+            routed = cluster.route(message['target'], 'control', msgtype,
+                                   data)
+            if routed is not None:
+                return routed_response(routed, msgid)
             return ('control', None, 'error',
                     {'msg': 'no such client'}, msgid)
         receivers.append(target)
 
-    data = dict()
-    data['tags'] = message['tags']
+    return ('control', receivers, msgtype, data, None)
+
 
-    return ('control', receivers, 'track_articles', data, None)
+@gen.coroutine
+def routed_response(routed, msgid):
+    '''
+    Wait until the other workers replied to a routed message.
+
+    :param routed: Future of cluster.route
+    :param msgid: Message ID
+    :return: None if delivered, otherwise an error response
+    '''
+    delivered = yield routed
+    if delivered:
+        raise gen.Return(None)
+    raise gen.Return(('control', None, 'error',
+                      {'msg': 'no such client'}, msgid))
 
 def handle_create_beacon_configuration(client, msgid, msg, user):
 
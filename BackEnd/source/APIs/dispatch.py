@@ -0,0 +1,124 @@
+import sys
+from multiprocessing.pool import ThreadPool
+from tornado import gen
+from tornado import locks
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from config_handler import config
+
+# Executor for the blocking message handlers, created on first use so no
+# threads exist yet when the backend forks its workers
+executor = None
+# HandlerLimit per (API name, message type)
+limits = {}
+
+
+def blocking(func):
+    '''
+    Declare a message handler as blocking, e.g. because it does disk or
+    network I/O. It then runs on a bounded pool of threads instead of on the
+    IOLoop, so it does not stall the other connections.
+
+    :param func: Message handler
+    :return: The same message handler
+    '''
+    func.blocking = True
+    return func
+
+
+def is_blocking(func):
+    return getattr(func, 'blocking', False)
+
+
+def is_async(func):
+    '''
+    Check if a message handler does not complete right away, because it is
+    a coroutine or declared blocking.
+
+    :param func: Message handler
+    :return: True/False
+    '''
+    return is_blocking(func) or gen.is_coroutine_function(func)
+
+
+class ThreadPoolExecutor:
+    '''
+    Runs blocking functions on a bounded pool of threads. The results are
+    delivered as Futures resolved on the IOLoop.
+    '''
+    def __init__(self, threads, ioloop=None):
+        self.pool = ThreadPool(processes=threads)
+        self.ioloop = ioloop or IOLoop.current()
+
+    def submit(self, func, *args):
+        '''
+        Run a function on the pool.
+
+        :param func: Function
+        :param args: Arguments of the function
+        :return: Future with the result of the function
+        '''
+        future = Future()
+
+        def run():
+            try:
+                result = func(*args)
+            except Exception:
+                self.ioloop.add_callback(future.set_exc_info, sys.exc_info())
+            else:
+                self.ioloop.add_callback(future.set_result, result)
+
+        self.pool.apply_async(run)
+        return future
+
+
+def get_executor():
+    '''
+    Get the executor of the blocking message handlers, with the number of
+    threads of [handlers] executor_threads.
+
+    :return: ThreadPoolExecutor
+    '''
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(
+            config.getint('handlers', 'executor_threads'))
+    return executor
+
+
+class HandlerLimit:
+    '''
+    How many messages of one type may be handled at the same time, and how
+    long the handling may take before the client gets a timeout error.
+    '''
+    def __init__(self, concurrency, timeout):
+        self.semaphore = locks.Semaphore(concurrency)
+        self.timeout = timeout
+
+
+def get_option(api_name, msgtype, option, get):
+    '''
+    Read an option of the [handlers] section, either specific for the message
+    type as <api_name>.<msgtype>.<option> or the default.
+    '''
+    specific = '%s.%s.%s' % (api_name, msgtype, option)
+    if config.has_option('handlers', specific):
+        return get('handlers', specific)
+    return get('handlers', option)
+
+
+def limit_for(api_name, msgtype):
+    '''
+    Get the limit of a message type.
+
+    :param api_name: Name of the API handler, e.g. 'control'
+    :param msgtype: Message type
+    :return: HandlerLimit
+    '''
+    limit = limits.get((api_name, msgtype))
+    if limit is None:
+        limit = HandlerLimit(
+            get_option(api_name, msgtype, 'concurrency', config.getint),
+            get_option(api_name, msgtype, 'timeout', config.getfloat))
+        limits[(api_name, msgtype)] = limit
+    return limit
@@ -0,0 +1,128 @@
+import json
+import logging
+import tornado.web
+from tornado import gen
+import client
+from config_handler import config
+from envelope import EncodedMessage
+from APIs.baseConnectionHandler import routes
+
+
+def broadcast(receivers, handler, msgtype, message, respond_id=None):
+    '''
+    Send a message resulting from an HTTP request to its receivers.
+
+    :param receivers: List of clients
+    :param handler: Handler, also the type of channel to send through
+    :param msgtype: Message type
+    :param message: Message
+    :param respond_id: Message Id. If None, every channel generates its own
+    :return: None
+    '''
+    encoded = EncodedMessage(handler, msgtype, message)
+    for r in receivers:
+        channel = r.get_channel(handler)
+        if channel is not None:
+            channel.send_encoded(encoded, respond_id)
+
+
+class HttpAPIHandler(tornado.web.RequestHandler):
+    '''
+    The API handlers over plain HTTP, for dashboards and scripts that only
+    need a response and no websocket session. The server keeps connections
+    alive between requests.
+
+        GET  /API-http/health               Health check
+        GET  /API-http/<handler>/<command>  Data from the query arguments
+        POST /API-http/<handler>/<command>  Data as JSON object in the body
+        POST /API-http/batch                JSON list of commands, as in the
+                                            'batch' websocket message
+
+    The response is the result of the command, a JSON object with msgid,
+    handler, command and data of the response, or a list of them for a batch.
+    Cached listings carry an ETag, so polling with If-None-Match gets a 304
+    as long as nothing changed.
+    '''
+    def get(self, path):
+        if path == 'health':
+            self.write({'status': 'ok',
+                        'clients': len(client.clients)})
+            return
+        data = dict((name, self.get_argument(name))
+                    for name in self.request.arguments)
+        return self.run(path, data)
+
+    def post(self, path):
+        try:
+            data = json.loads(self.request.body or 'null')
+        except ValueError:
+            self.send_error_result(400, 'Malformed JSON body')
+            return
+        if path == 'batch':
+            return self.run_batch(data)
+        if data is None:
+            data = {}
+        return self.run(path, data)
+
+    @gen.coroutine
+    def run(self, path, data):
+        '''
+        Handle the command named by the path.
+
+        :param path: <handler>/<command>
+        :param data: Data of the command
+        :return: None
+        '''
+        try:
+            handler, msgtype = path.split('/')
+        except ValueError:
+            self.send_error_result(404, 'Path must be <handler>/<command>')
+            return
+        result = yield routes.run_command(
+            {'handler': handler, 'command': msgtype, 'data': data},
+            None, None, broadcast)
+        if result.encoded is not None:
+            # Cached snapshot: reuse its encoding, and let the client poll
+            # with If-None-Match
+            self.set_header('Etag', result.encoded.etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+            self.write(result.encoded.for_msgid(None))
+            return
+        if result['command'] == 'error':
+            if routes.get(handler, msgtype) is None:
+                self.set_status(404)
+            else:
+                self.set_status(400)
+        self.write(result)
+
+    @gen.coroutine
+    def run_batch(self, commands):
+        '''
+        Handle a list of commands in order.
+
+        :param commands: Commands
+        :return: None
+        '''
+        if not isinstance(commands, list):
+            self.send_error_result(400, 'Batch must be a list of commands')
+            return
+        max_commands = config.getint('server', 'max_batch_commands')
+        if len(commands) > max_commands:
+            self.send_error_result(
+                400, 'Batch holds more than %d commands' % max_commands)
+            return
+        results = []
+        for command in commands:
+            result = yield routes.run_command(command, None, None, broadcast)
+            results.append(result)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps(results))
+
+    def send_error_result(self, status, msg):
+        logging.warning('HTTP API request %s: %s' % (self.request.path, msg))
+        self.set_status(status)
+        self.write({'handler': 'http', 'command': 'error',
+                    'data': {'msg': msg}})
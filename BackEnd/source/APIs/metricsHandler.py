@@ -0,0 +1,11 @@
+import tornado.web
+import metrics
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    '''
+    Serves the counters of the backend in the Prometheus text format.
+    '''
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.render())
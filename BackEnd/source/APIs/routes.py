@@ -0,0 +1,228 @@
+import time
+import tornado.concurrent
+from tornado import gen
+import metrics
+from envelope import EncodedMessage
+import APIs.dispatch as dispatch
+
+QUANTILES = [0.5, 0.99, 0.999]
+
+
+class Route:
+    '''
+    A (handler, command) pair, with the message handler function for it and
+    the counters of the messages it handled.
+    '''
+    def __init__(self, api, msgtype, func):
+        '''
+        Create a route
+
+        :param api: API handler, e.g. ControlAPIHandler
+        :param msgtype: Message type
+        :param func: Message handler function
+        :return: None
+        '''
+        self.api = api
+        self.msgtype = msgtype
+        self.func = func
+        self.asynchronous = dispatch.is_async(func)
+        self.requests = 0
+        self.errors = 0
+        # Time spent on the IOLoop, for coroutines only up to the first yield
+        self.loop_seconds = 0.0
+        # Time until the response is ready
+        self.latency = metrics.Histogram()
+
+    def handle(self, msgid, data, client, user=None):
+        '''
+        Handle a message and count it.
+
+        :param msgid: Message ID
+        :param data: Data
+        :param client: Client
+        :param user: User
+        :return: Response, or Future of the response
+        '''
+        self.requests += 1
+        start = time.time()
+        try:
+            if self.asynchronous:
+                response = self.api.handle_async(self.func, msgid,
+                                                 self.msgtype, data, client,
+                                                 user)
+            else:
+                response = self.api.handle_sync(self.func, msgid, data,
+                                                client, user)
+        except Exception:
+            self.errors += 1
+            self.loop_seconds += time.time() - start
+            self.latency.observe(time.time() - start)
+            raise
+        elapsed = time.time() - start
+        self.loop_seconds += elapsed
+        if tornado.concurrent.is_future(response):
+            response.add_done_callback(
+                lambda future: self.on_response_ready(start, future))
+        else:
+            self.record(elapsed, response)
+        return response
+
+    def on_response_ready(self, start, future):
+        if future.exception() is not None:
+            self.errors += 1
+            self.latency.observe(time.time() - start)
+        else:
+            self.record(time.time() - start, future.result())
+
+    def record(self, elapsed, response):
+        self.latency.observe(elapsed)
+        if response is not None and response[2] == 'error':
+            self.errors += 1
+
+
+class CommandResult(dict):
+    '''
+    Result of a command run by RouteTable.run_command. If the response was a
+    cached snapshot, encoded holds its EncodedMessage.
+    '''
+    encoded = None
+
+
+class RouteTable:
+    '''
+    All (handler, command) routes of the API handlers in one dict, so a
+    message is routed with a single lookup.
+    '''
+    def __init__(self, api_handlers):
+        '''
+        Build the routes
+
+        :param api_handlers: Dict of API handlers per handler name
+        :return: None
+        '''
+        self.routes = {}
+        self.api_names = set(api_handlers)
+        for name, api in api_handlers.items():
+            for msgtype, func in api.message_handlers.items():
+                self.routes[(name, msgtype)] = Route(api, msgtype, func)
+
+    def get(self, handler, msgtype):
+        '''
+        Find the route of a message.
+
+        :param handler: Handler, e.g. 'control'
+        :param msgtype: Message type
+        :return: Route, or None if there is none
+        '''
+        return self.routes.get((handler, msgtype))
+
+    def unknown_route_error(self, handler):
+        '''
+        Get the error for a message without a route.
+
+        :param handler: Handler of the message
+        :return: Error message
+        '''
+        if handler in self.api_names:
+            return 'Unknown messagetype'
+        return 'Unknown handler "' + handler + '"'
+
+    @gen.coroutine
+    def run_command(self, command, default_msgid, client, broadcast):
+        '''
+        Handle a command given as a dict with 'handler', 'command', 'data'
+        and optionally 'msgid', as in a batch. Messages for other receivers
+        are sent right away, a response for the sender becomes the result.
+
+        :param command: Command
+        :param default_msgid: Message Id for a command without its own
+        :param client: Client sending the command, or None
+        :param broadcast: Function sending a message to other receivers,
+         called with receivers, handler, msgtype, data and respond id
+        :return: CommandResult, a dict with the msgid of the command, handler,
+         command and data of the response
+        '''
+        try:
+            handler = command['handler']
+            msgtype = command['command']
+            data = command['data']
+        except KeyError as e:
+            raise gen.Return(
+                {'msgid': None, 'handler': 'batch', 'command': 'error',
+                 'data': {'msg': 'Missing parameter "' + e.args[0] + '"'}})
+        except TypeError:
+            raise gen.Return(
+                {'msgid': None, 'handler': 'batch', 'command': 'error',
+                 'data': {'msg': 'Command must be an object'}})
+
+        msgid = command.get('msgid')
+        route = self.get(handler, msgtype)
+        if route is None:
+            raise gen.Return({'msgid': msgid, 'handler': handler,
+                              'command': 'error',
+                              'data': {'msg':
+                                       self.unknown_route_error(handler)}})
+        if msgid is None:
+            msgid = default_msgid
+        response = route.handle(msgid, data, client, None)
+        if tornado.concurrent.is_future(response):
+            response = yield response
+
+        result = CommandResult(msgid=command.get('msgid'), handler=handler,
+                               command='ack', data=None)
+        if response is not None:
+            r_channel, r_receivers, r_msgtype, r_message, \
+                r_respondID = response
+            if isinstance(r_message, EncodedMessage):
+                result.encoded = r_message
+                r_message = r_message.data
+            if r_receivers is None:
+                result['handler'] = r_channel
+                result['command'] = r_msgtype
+                result['data'] = r_message
+            elif len(r_receivers) > 0:
+                broadcast(r_receivers, r_channel, r_msgtype, r_message,
+                          r_respondID)
+        raise gen.Return(result)
+
+    def collect(self, writer):
+        '''
+        Write the counters of all routes.
+
+        :param writer: metrics.MetricsWriter
+        :return: None
+        '''
+        routes = sorted(self.routes.items())
+        writer.header('iot_route_requests_total', 'counter',
+                      'Messages handled per route')
+        for (handler, msgtype), route in routes:
+            writer.sample('iot_route_requests_total',
+                          [('handler', handler), ('command', msgtype)],
+                          route.requests)
+        writer.header('iot_route_errors_total', 'counter',
+                      'Messages per route answered with an error')
+        for (handler, msgtype), route in routes:
+            writer.sample('iot_route_errors_total',
+                          [('handler', handler), ('command', msgtype)],
+                          route.errors)
+        writer.header('iot_route_ioloop_seconds_total', 'counter',
+                      'Time spent on the IOLoop handling messages per route')
+        for (handler, msgtype), route in routes:
+            writer.sample('iot_route_ioloop_seconds_total',
+                          [('handler', handler), ('command', msgtype)],
+                          route.loop_seconds)
+        writer.header('iot_route_latency_seconds', 'histogram',
+                      'Time until the response is ready per route')
+        for (handler, msgtype), route in routes:
+            writer.histogram('iot_route_latency_seconds',
+                             [('handler', handler), ('command', msgtype)],
+                             route.latency)
+        writer.header('iot_route_latency_quantile_seconds', 'gauge',
+                      'Latency quantiles per route, estimated from the ' +
+                      'histogram')
+        for (handler, msgtype), route in routes:
+            for q in QUANTILES:
+                writer.sample('iot_route_latency_quantile_seconds',
+                              [('handler', handler), ('command', msgtype),
+                               ('quantile', str(q))],
+                              route.latency.quantile(q))
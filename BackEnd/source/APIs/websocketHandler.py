@@ -1,13 +1,72 @@
 import tornado.websocket
 import logging
 import APIs.baseConnectionHandler as baseConnectionHandler
+import admission
 import client
+import compression
+import heartbeat
+import serialization
 from config_handler import config
-import pprint
+import metrics
+import time
+
+# Codecs the server accepts when a client requests one through a subprotocol
+accepted_codecs = [codec for codec in
+                   [serialization.get_codec(name) for name in
+                    config.get('server', 'codecs').split(',')]
+                   if codec is not None]
+# Connection limits checked before the websocket handshake
+admission_control = admission.create_controller(config)
+metrics.register(admission_control)
+
+
+class HeartbeatMetrics:
+    '''
+    Round trip times of the keep-alive pings over all channels, and the
+    channels closed because their peer stopped answering them.
+    '''
+    def __init__(self):
+        self.rtt = metrics.Histogram()
+        self.reaped = 0
+
+    def collect(self, writer):
+        writer.header('iot_ping_rtt_seconds', 'histogram',
+                      'Round trip time of websocket pings')
+        writer.histogram('iot_ping_rtt_seconds', [], self.rtt)
+        writer.header('iot_reaped_connections_total', 'counter',
+                      'Connections closed for not answering pings')
+        writer.sample('iot_reaped_connections_total', [], self.reaped)
+
+
+heartbeat_metrics = HeartbeatMetrics()
+metrics.register(heartbeat_metrics)
+ping_interval, ping_timeout = heartbeat.ping_settings(config)
 
 
 class WebsocketAPIHandler(baseConnectionHandler.BaseConnectionHandler,
                           tornado.websocket.WebSocketHandler):
+    # IP counted as open connection in admission_control, until closed
+    admitted_ip = None
+
+    def prepare(self):
+        '''
+        Admit or reject the connection before the websocket handshake. A
+        rejected client gets a plain HTTP 429 if it has too many connections
+        or opens them too fast, or 503 if the server is at its limit, with a
+        Retry-After header. No client or channel is created for it.
+
+        :return: None
+        '''
+        rejection = admission_control.admit(self.request.remote_ip)
+        if rejection is None:
+            return
+        reason, status, retry_after = rejection
+        logging.warning('Rejected connection from %s: %s' %
+                        (self.request.remote_ip, reason))
+        self.set_status(status, admission.status_reasons[status])
+        self.set_header('Retry-After', str(retry_after))
+        self.finish('Connection rejected: %s\n' % reason)
+
     def open(self, identifier):
         '''
         Handle an incoming connection. Opens up a new channel with the client
@@ -18,14 +77,14 @@ class WebsocketAPIHandler(baseConnectionHandler.BaseConnectionHandler,
         '''
         self.setup()
         self.ip = self.request.remote_ip
+        self.last_pong = time.time()
+        admission_control.connected(self.ip)
+        self.admitted_ip = self.ip
         logging.info('Creating client for %s from %s' % (self.remote_host,
                                                          self.ip) +
                      ' |' + str(self))
         self.client = client.get_client(self.ip, self.remote_host, self)
-        ppdata = pprint.pformat([{c.ws: (c.ip, c.host)}
-                                 for c in client.clients.values()])
-        logging.info("Current clients on connection==================")
-        logging.info(ppdata)
+        client.log_clients("Current clients on connection==================")
         num_channels = len(self.client.channels)
         if num_channels >= config.getint('server',
                                          'max_connections_per_client'):
@@ -45,6 +104,58 @@ class WebsocketAPIHandler(baseConnectionHandler.BaseConnectionHandler,
         logging.info('%s from %s is now connected as websocket, channel %d' %
                      (client_name, self.ip, self.id))
 
+    def on_close(self):
+        '''
+        Handle closing of a connection, and stop counting it.
+
+        :return: None
+        '''
+        if self.admitted_ip is not None:
+            admission_control.disconnected(self.admitted_ip)
+            self.admitted_ip = None
+            if ping_interval > 0 and \
+                    time.time() - self.last_pong > ping_timeout:
+                heartbeat_metrics.reaped += 1
+                logging.warning('%s, channel %s stopped answering pings' %
+                                (self.ip, self.id))
+        baseConnectionHandler.BaseConnectionHandler.on_close(self)
+
+    def on_pong(self, data):
+        '''
+        Measure the round trip time of the keep-alive ping that was answered.
+
+        :param data: Payload of the pong
+        :return: None
+        '''
+        self.last_pong = time.time()
+        seconds = self.rtt.observe_pong(self.ws_connection)
+        if seconds is not None:
+            heartbeat_metrics.rtt.observe(seconds)
+
+    def get_compression_options(self):
+        '''
+        Offer permessage-deflate if enabled in the [compression] section.
+
+        :return: Compression options, or None to disable compression
+        '''
+        return compression.compression_options(config)
+
+    def get_websocket_protocol(self):
+        '''
+        Create the websocket protocol for this channel. Only messages of at
+        least the configured minimum size are compressed, and the compression
+        of the channel is counted in compression_stats.
+
+        :return: Websocket protocol, or None for unsupported versions
+        '''
+        websocket_version = self.request.headers.get("Sec-WebSocket-Version")
+        if websocket_version in ("7", "8", "13"):
+            self.compression_stats = compression.CompressionStats()
+            return compression.ThresholdWebSocketProtocol(
+                self, compression_options=self.get_compression_options(),
+                min_size=config.getint('compression', 'min_size'),
+                stats=self.compression_stats)
+
     def check_origin(self, origin):
         '''
         Check origin of message
@@ -60,12 +171,24 @@ class WebsocketAPIHandler(baseConnectionHandler.BaseConnectionHandler,
         sent embedded within the 'setchannelmode' command in the 'clientname'
         field.
 
+        Subprotocols starting with 'iot.' request a codec, e.g. 'iot.msgpack'.
+        The first requested codec the server accepts is used for the channel
+        and selected as subprotocol. Without one, the channel uses JSON.
+
         :param subprotocols:
         :return:
         '''
         self.remote_host = None
-        if len(subprotocols) > 0:
-            self.remote_host = subprotocols[0]
+        selected_codec = None
+        for subprotocol in subprotocols:
+            if subprotocol.startswith(serialization.SUBPROTOCOL_PREFIX):
+                codec = serialization.codec_for_subprotocol(subprotocol)
+                if selected_codec is None and codec in accepted_codecs:
+                    selected_codec = codec
+            elif self.remote_host is None:
+                self.remote_host = subprotocol
+
+        if self.remote_host is not None:
             try:
                 if self.client is not None:
                     self.client.host = self.remote_host
@@ -74,4 +197,9 @@ class WebsocketAPIHandler(baseConnectionHandler.BaseConnectionHandler,
                 logging.info("Client not yet created.")
             logging.info('Subprotocol arg: ' + self.remote_host + ' |' +
                          str(self))
+        if selected_codec is not None:
+            self.codec = selected_codec
+            logging.info('Using codec %s |%s' % (selected_codec.name,
+                                                  str(self)))
+            return serialization.subprotocol_for(selected_codec)
         return self.remote_host
@@ -0,0 +1,173 @@
+import logging
+import math
+import time
+from ratelimit import TokenBucket
+
+# Reasons to reject a connection, with the HTTP status answered
+REJECT_IP_CONNECTIONS = 'ip_connections'
+REJECT_IP_RATE = 'ip_rate'
+REJECT_SERVER_CONNECTIONS = 'server_connections'
+REJECT_SERVER_RATE = 'server_rate'
+reject_status = {REJECT_IP_CONNECTIONS: 429,
+                 REJECT_IP_RATE: 429,
+                 REJECT_SERVER_CONNECTIONS: 503,
+                 REJECT_SERVER_RATE: 503}
+# Reason phrases, httplib of Python 2 does not know 429
+status_reasons = {429: 'Too Many Requests',
+                  503: 'Service Unavailable'}
+
+
+class AdmissionController:
+    '''
+    Decides whether a new websocket connection is accepted, before the
+    handshake. Limits the open connections per IP and in total, and the rate
+    of new connections per IP and in total with token buckets. A rejected
+    request only costs a few dict lookups.
+    '''
+    def __init__(self, max_connections, max_connections_per_ip, ip_rate,
+                 ip_burst, server_rate, server_burst, retry_after,
+                 max_tracked_ips=10000):
+        '''
+        Create the admission controller
+
+        :param max_connections: Maximum number of open connections
+        :param max_connections_per_ip: Maximum open connections of one IP
+        :param ip_rate: New connections per second of one IP
+        :param ip_burst: New connections of one IP at once
+        :param server_rate: New connections per second in total
+        :param server_burst: New connections at once in total
+        :param retry_after: Seconds a client rejected for too many open
+         connections is asked to wait
+        :param max_tracked_ips: Number of per IP buckets kept before the full
+         ones are dropped
+        :return: None
+        '''
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst
+        self.retry_after = retry_after
+        self.max_tracked_ips = max_tracked_ips
+        self.server_bucket = TokenBucket(server_rate, server_burst,
+                                         time.time())
+        # TokenBucket per IP
+        self.ip_buckets = {}
+        # Open connections, per IP and in total
+        self.connections_by_ip = {}
+        self.connections = 0
+        # Counters
+        self.admitted = 0
+        self.rejected = dict((reason, 0) for reason in reject_status)
+
+    def admit(self, ip):
+        '''
+        Check if a new connection from an IP is accepted.
+
+        :param ip: IP of the client
+        :return: None if accepted, otherwise (reason, HTTP status, seconds to
+         retry after)
+        '''
+        if self.connections >= self.max_connections:
+            return self.reject(REJECT_SERVER_CONNECTIONS, self.retry_after)
+        if self.connections_by_ip.get(ip, 0) >= self.max_connections_per_ip:
+            return self.reject(REJECT_IP_CONNECTIONS, self.retry_after)
+
+        now = time.time()
+        bucket = self.ip_buckets.get(ip)
+        if bucket is None:
+            if len(self.ip_buckets) >= self.max_tracked_ips:
+                self.drop_full_buckets(now)
+            bucket = TokenBucket(self.ip_rate, self.ip_burst, now)
+            self.ip_buckets[ip] = bucket
+        wait = bucket.take(now)
+        if wait:
+            return self.reject(REJECT_IP_RATE, wait)
+        wait = self.server_bucket.take(now)
+        if wait:
+            # Not this client's fault, give its token back
+            bucket.tokens += 1
+            return self.reject(REJECT_SERVER_RATE, wait)
+        self.admitted += 1
+        return None
+
+    def reject(self, reason, retry_after):
+        self.rejected[reason] += 1
+        return (reason, reject_status[reason],
+                int(math.ceil(min(retry_after, 3600))))
+
+    def drop_full_buckets(self, now):
+        '''
+        Forget the buckets of IPs that did not connect for a while, their
+        buckets are full again and behave like new ones. If that frees
+        nothing, e.g. when many IPs connect at once, forget all of them
+        rather than grow without bound.
+
+        :param now: Current time in seconds
+        :return: None
+        '''
+        for ip in [ip for ip, bucket in self.ip_buckets.items()
+                   if bucket.is_full(now)]:
+            del self.ip_buckets[ip]
+        if len(self.ip_buckets) >= self.max_tracked_ips:
+            logging.warning('Connection rate tracked for %d IPs, resetting' %
+                            len(self.ip_buckets))
+            self.ip_buckets.clear()
+
+    def connected(self, ip):
+        '''
+        Count an open connection.
+
+        :param ip: IP of the client
+        :return: None
+        '''
+        self.connections += 1
+        self.connections_by_ip[ip] = self.connections_by_ip.get(ip, 0) + 1
+
+    def disconnected(self, ip):
+        '''
+        Stop counting a closed connection.
+
+        :param ip: IP of the client
+        :return: None
+        '''
+        self.connections -= 1
+        remaining = self.connections_by_ip.get(ip, 0) - 1
+        if remaining > 0:
+            self.connections_by_ip[ip] = remaining
+        else:
+            self.connections_by_ip.pop(ip, None)
+
+    def collect(self, writer):
+        '''
+        Write the counters.
+
+        :param writer: metrics.MetricsWriter
+        :return: None
+        '''
+        writer.header('iot_connections', 'gauge', 'Open websocket connections')
+        writer.sample('iot_connections', [], self.connections)
+        writer.header('iot_admission_total', 'counter',
+                      'Websocket connection attempts by result')
+        writer.sample('iot_admission_total', [('result', 'admitted')],
+                      self.admitted)
+        for reason, count in sorted(self.rejected.items()):
+            writer.sample('iot_admission_total', [('result', reason)], count)
+
+
+def create_controller(config):
+    '''
+    Create an admission controller with the settings of the [admission]
+    section.
+
+    :param config: Configuration
+    :return: AdmissionController
+    '''
+    return AdmissionController(
+        max_connections=config.getint('admission', 'max_connections'),
+        max_connections_per_ip=config.getint('admission',
+                                             'max_connections_per_ip'),
+        ip_rate=config.getfloat('admission', 'ip_rate'),
+        ip_burst=config.getint('admission', 'ip_burst'),
+        server_rate=config.getfloat('admission', 'server_rate'),
+        server_burst=config.getint('admission', 'server_burst'),
+        retry_after=config.getint('admission', 'retry_after'))
@@ -1,8 +1,255 @@
 import logging
+from collections import OrderedDict
 from config_handler import config
 import pprint
+import time
+import ratelimit
 
-clients = {}
+# Kinds of client. Bags identify themselves with a name starting with 'SB'
+KIND_BAG = 'bag'
+KIND_WEB = 'web'
+BAG_NAME_PREFIX = 'SB'
+
+# Presence events: a client got its first channel, lost its last channel,
+# or changed its name
+PRESENCE_JOIN = 'join'
+PRESENCE_LEAVE = 'leave'
+PRESENCE_RENAME = 'rename'
+# Functions called with (event, client) on every presence event
+presence_listeners = []
+
+
+class ClientRegistry:
+    '''
+    Registry of all connected clients. Clients are stored by their key
+    (ip, remote_host, wsHandler) and additionally indexed by IP, name, id and
+    kind, so every lookup is a dict access instead of a scan over all
+    clients. The indexes are kept up to date when a client is added, removed
+    or reindexed after its information changed.
+
+    Each index maps a value to an ordered bucket of clients, so lookups keep
+    returning the client that was registered first.
+
+    version counts the changes to the registered clients and their channels,
+    so cached listings can tell whether they are still up to date.
+
+    Every connection is a client of its own, so the inbound limit of the
+    [inbound] section for all connections of a client is a token bucket per
+    (ip, remote_host), shared by the clients registered from there.
+    '''
+    def __init__(self):
+        self.by_key = {}
+        self.by_ip = {}
+        # (ip, remote_host) -> [inbound TokenBucket, number of clients]
+        self.inbound_buckets = {}
+        self.by_name = {}
+        self.by_id = {}
+        self.by_kind = {KIND_BAG: OrderedDict(), KIND_WEB: OrderedDict()}
+        # Values each client is currently indexed under, per key
+        self.indexed = {}
+        self.version = 0
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def values(self):
+        return list(self.by_key.values())
+
+    def get_or_create(self, key, create):
+        '''
+        Return the client stored under key. If there is none, create one and
+        add it.
+
+        :param key: (ip, remote_host, wsHandler)
+        :param create: Function returning a new client
+        :return: Client
+        '''
+        existing = self.by_key.get(key)
+        if existing is not None:
+            return existing
+        client = create()
+        self.add(key, client)
+        return client
+
+    def add(self, key, client):
+        '''
+        Add a client and index it.
+
+        :param key: (ip, remote_host, wsHandler)
+        :param client: Client
+        :return: None
+        '''
+        if key in self.by_key:
+            self.remove(key)
+        client.key = key
+        self.by_key[key] = client
+        self.index(key, client)
+        shared = self.inbound_buckets.get(key[:2])
+        if shared is None:
+            shared = [ratelimit.create_bucket(config, 'inbound', 'client',
+                                              time.time()), 0]
+            self.inbound_buckets[key[:2]] = shared
+        shared[1] += 1
+        client.inbound_bucket = shared[0]
+
+    def remove(self, key):
+        '''
+        Remove a client and drop it from all indexes.
+
+        :param key: (ip, remote_host, wsHandler)
+        :return: None
+        :raises KeyError: If no client is registered under key
+        '''
+        del self.by_key[key]
+        self.unindex(key)
+        shared = self.inbound_buckets[key[:2]]
+        shared[1] -= 1
+        if shared[1] == 0:
+            del self.inbound_buckets[key[:2]]
+
+    def release(self, client):
+        '''
+        Remove a client if it is still registered, under the key it was
+        added with. Releasing it again does nothing, so a client is removed
+        exactly once however its channels close.
+
+        :param client: Client
+        :return: True if the client was removed now
+        '''
+        key = client.key
+        if key is None or self.by_key.get(key) is not client:
+            return False
+        self.remove(key)
+        return True
+
+    def reindex(self, client):
+        '''
+        Update the indexes after the name, id or kind of a client changed.
+        Clients that are not registered (yet) are ignored.
+
+        :param client: Client
+        :return: None
+        '''
+        key = getattr(client, 'key', None)
+        if key is None or self.by_key.get(key) is not client:
+            return
+        # The host may have changed even if the indexed values did not
+        self.changed()
+        if self.indexed[key] == (client.ip, client.name, client.id,
+                                 client.kind):
+            return
+        self.unindex(key)
+        self.index(key, client)
+
+    def changed(self):
+        '''
+        Record a change to a client or its channels.
+
+        :return: None
+        '''
+        self.version += 1
+
+    def index(self, key, client):
+        self.version += 1
+        values = (client.ip, client.name, client.id, client.kind)
+        self.indexed[key] = values
+        self.by_ip.setdefault(client.ip, OrderedDict())[key] = client
+        self.by_name.setdefault(client.name, OrderedDict())[key] = client
+        self.by_id.setdefault(client.id, OrderedDict())[key] = client
+        self.by_kind[client.kind][key] = client
+
+    def unindex(self, key):
+        self.version += 1
+        ip, name, client_id, kind = self.indexed.pop(key)
+        self.discard(self.by_ip, ip, key)
+        self.discard(self.by_name, name, key)
+        self.discard(self.by_id, client_id, key)
+        del self.by_kind[kind][key]
+
+    @staticmethod
+    def discard(index, value, key):
+        bucket = index[value]
+        del bucket[key]
+        if len(bucket) == 0:
+            del index[value]
+
+    @staticmethod
+    def first(index, value):
+        bucket = index.get(value)
+        if not bucket:
+            return None
+        return bucket[next(iter(bucket))]
+
+    def find_by_ip(self, ip):
+        return self.first(self.by_ip, ip)
+
+    def find_by_name(self, name):
+        return self.first(self.by_name, name)
+
+    def find_by_id(self, client_id):
+        return self.first(self.by_id, client_id)
+
+    def find_by_kind(self, kind):
+        '''
+        Find all clients of a kind.
+
+        :param kind: KIND_BAG or KIND_WEB
+        :return: List of clients, in order of registration
+        '''
+        return list(self.by_kind[kind].values())
+
+
+clients = ClientRegistry()
+
+
+class RoundRobinSelection:
+    '''
+    Channel selection policy that hands out the channels of a type in turn.
+    '''
+    name = 'round_robin'
+
+    def select(self, client, channel_type, channel_ids):
+        '''
+        Select one of the candidate channels.
+
+        :param client: Client owning the channels
+        :param channel_type: Type of channel the candidates were found for
+        :param channel_ids: Non-empty list of candidate channel ids
+        :return: Selected channel id
+        '''
+        turn = client.selection_turns.get(channel_type, 0)
+        client.selection_turns[channel_type] = turn + 1
+        return channel_ids[turn % len(channel_ids)]
+
+
+class LeastOutstandingSelection:
+    '''
+    Channel selection policy that picks the channel with the fewest messages
+    still waiting to be flushed. The candidates are bounded by
+    max_connections_per_client, so this stays constant time per lookup.
+    '''
+    name = 'least_outstanding'
+
+    def select(self, client, channel_type, channel_ids):
+        '''
+        Select one of the candidate channels.
+
+        :param client: Client owning the channels
+        :param channel_type: Type of channel the candidates were found for
+        :param channel_ids: Non-empty list of candidate channel ids
+        :return: Selected channel id
+        '''
+        return min(channel_ids,
+                   key=lambda channel_id:
+                   client.channels[channel_id][0].outbound.depth())
+
+
+channel_selection_policies = {
+    RoundRobinSelection.name: RoundRobinSelection,
+    LeastOutstandingSelection.name: LeastOutstandingSelection
+}
+channel_selection = channel_selection_policies[
+    config.get('server', 'channel_selection')]()
 
 
 class Client:
@@ -17,9 +264,17 @@ class Client:
         self.host = remote_host
         self.ws = wsHandler
         self.channels = {}
+        # Channel ids per channel type, and selection state per type
+        self.channels_by_type = {}
+        self.selection_turns = {}
         self.name = None
         self.id = None
+        self.kind = KIND_WEB
         self.from_trusted_ip = False
+        self.key = None
+        # Inbound messages of all connections from the same ip and
+        # remote_host together, set by the registry
+        self.inbound_bucket = None
         self.client_load_info()
 
     def set_name(self, name):
@@ -31,10 +286,7 @@ class Client:
         '''
         self.host = name
         self.client_load_info()
-        ppdata = pprint.pformat([{c.ws: (c.ip, c.host)}
-                                 for c in clients.values()])
-        logging.info("Current clients after update==================")
-        logging.info(ppdata)
+        log_clients("Current clients after update==================")
         return
 
     def client_load_info(self):
@@ -43,12 +295,21 @@ class Client:
 
         :return: None
         '''
+        previous = (self.name, self.kind)
         self.name = self.host
         self.id = -1
         self.from_trusted_ip = True
-
-        logging.info("Client info loaded: %s, %s, %s, %s" %
-                     (self.ip, self.host, self.id, self.from_trusted_ip))
+        if self.name is not None and self.name.startswith(BAG_NAME_PREFIX):
+            self.kind = KIND_BAG
+        else:
+            self.kind = KIND_WEB
+        clients.reindex(self)
+        if self.channels and (self.name, self.kind) != previous:
+            notify_presence(PRESENCE_RENAME, self)
+
+        logging.info("Client info loaded: %s, %s, %s, %s, %s" %
+                     (self.ip, self.host, self.id, self.from_trusted_ip,
+                      self.kind))
         return
 
     def add_channel(self, channel, channel_type=None):
@@ -70,24 +331,33 @@ class Client:
 
         channel_id = try_id
         self.channels[channel_id] = (channel, channel_type)
+        self.channels_by_type.setdefault(channel_type, []).append(channel_id)
+        clients.changed()
+        if len(self.channels) == 1:
+            notify_presence(PRESENCE_JOIN, self)
         return channel_id
 
     def get_channel(self, channel_type):
         '''
-        Get a channel based on the channel type.
+        Get a channel based on the channel type. If there are several channels
+        of that type, the channel selection policy decides which one is used.
 
         :param channel_type: Type of channel
         :return: Channel
         '''
-        for channel_id, channel in self.channels.items():
-            if channel[1] == channel_type:
-                return channel[0]
-
-        # No specific channel found. Return the first channel with type None.
-        # TODO: More intelligence, select a random channel for load balancing
-        for channel_id, channel in self.channels.items():
-            if channel[1] is None:
-                return channel[0]
+        channel_ids = self.channels_by_type.get(channel_type)
+        if not channel_ids:
+            # No specific channel found. Fall back to channels with type None.
+            channel_type = None
+            channel_ids = self.channels_by_type.get(None)
+
+        if channel_ids:
+            if len(channel_ids) == 1:
+                channel_id = channel_ids[0]
+            else:
+                channel_id = channel_selection.select(self, channel_type,
+                                                      channel_ids)
+            return self.channels[channel_id][0]
 
         # No channel found
         logging.error('Client %s %s:' % (self.name, self.ip) +
@@ -103,15 +373,17 @@ class Client:
         :return: None
         '''
         try:
-            del self.channels[channel_id]
+            channel_type = self.channels.pop(channel_id)[1]
+            self.unindex_channel(channel_id, channel_type)
+            clients.changed()
         except KeyError:
             logging.warning('Client %s %s: Can\'t remove channel %d ' %
                             (self.name, self.ip, channel_id)
                             + ' - does not exist')
 
-        if len(self.channels) == 0:
-            # Stop existing
-            del clients[(self.ip, None, self.ws)]
+        if len(self.channels) == 0 and clients.release(self):
+            # Stopped existing
+            notify_presence(PRESENCE_LEAVE, self)
 
     def set_channeltype(self, channel_id, channel_type):
         '''
@@ -122,8 +394,12 @@ class Client:
         :return: None
         '''
         try:
-            self.channels[channel_id] = (self.channels[channel_id][0],
-                                         channel_type)
+            channel, old_type = self.channels[channel_id]
+            self.channels[channel_id] = (channel, channel_type)
+            self.unindex_channel(channel_id, old_type)
+            self.channels_by_type.setdefault(channel_type, []).append(
+                channel_id)
+            clients.changed()
             return True
         except KeyError:
             logging.error('Client %s %s: Can\'t set channeltype for channel %d'
@@ -131,6 +407,45 @@ class Client:
                           + ' - does not exist')
             return False
 
+    def get_channel_list(self, with_rtt=False):
+        '''
+        Get the id and type of all channels of the client.
+
+        :param with_rtt: Add the average round trip time in seconds
+        :return: List with a dict per channel
+        '''
+        channels = []
+        for channel_id, (channel, channel_type) in \
+                sorted(self.channels.items()):
+            elem = {'id': channel_id, 'type': channel_type}
+            if with_rtt:
+                elem['rtt'] = channel.rtt.average
+            channels.append(elem)
+        return channels
+
+    def get_stats(self):
+        '''
+        Get the counters of all channels of the client.
+
+        :return: List with a dict of counters per channel
+        '''
+        return [channel.get_stats() for channel, channel_type in
+                self.channels.values()]
+
+    def unindex_channel(self, channel_id, channel_type):
+        '''
+        Remove a channel from the channel type index.
+
+        :param channel_id: Id of channel
+        :param channel_type: Type the channel was indexed under
+        :return: None
+        '''
+        channel_ids = self.channels_by_type[channel_type]
+        channel_ids.remove(channel_id)
+        if len(channel_ids) == 0:
+            del self.channels_by_type[channel_type]
+            self.selection_turns.pop(channel_type, None)
+
     def remove(self):
         '''
         Remove client
@@ -143,11 +458,34 @@ class Client:
             self.remove_channel(channel_id)
 
         # Manually remove client if there were no channels
-        try:
-            del clients[(self.ip, self.host, self.ws)]
-        except KeyError:
-            # Already gone
-            pass
+        clients.release(self)
+
+
+def log_clients(title):
+    '''
+    Log all registered clients. The listing grows with the number of
+    clients, so it is only built if info messages are logged at all.
+
+    :param title: Line logged before the listing
+    :return: None
+    '''
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info(title)
+        logging.info(pprint.pformat([{c.ws: (c.ip, c.host)}
+                                     for c in clients.values()]))
+
+
+def notify_presence(event, target):
+    '''
+    Tell the presence listeners about a client that joined, left or was
+    renamed.
+
+    :param event: PRESENCE_JOIN, PRESENCE_LEAVE or PRESENCE_RENAME
+    :param target: Client
+    :return: None
+    '''
+    for listener in presence_listeners:
+        listener(event, target)
 
 
 def find_client(ip):
@@ -157,10 +495,7 @@ def find_client(ip):
     :param ip: IP of client
     :return:  If there is no client with that IP, return None.
     '''
-    for key, client in clients.items():
-        if client.ip == ip:
-            return client
-    return None
+    return clients.find_by_ip(ip)
 
 
 def find_client_by_id(client_id):
@@ -170,10 +505,7 @@ def find_client_by_id(client_id):
     :param client_id: Id of client
     :return: If there is no client with that id, return None.
     '''
-    for key, client in clients.items():
-        if client.id == client_id:
-            return client
-    return None
+    return clients.find_by_id(client_id)
 
 
 def find_client_by_name(client_name):
@@ -183,10 +515,7 @@ def find_client_by_name(client_name):
     :param client_name: Name of client
     :return:  If there is no client with that IP, return None.
     '''
-    for key, client in clients.items():
-        if client.name == client_name:
-            return client
-    return None
+    return clients.find_by_name(client_name)
 
 
 def find_clients_all():
@@ -195,22 +524,30 @@ def find_clients_all():
 
     :return: List containing all existing clients
     '''
-    all_clients = []
-    for key, client in clients.items():
-        all_clients.append(client)
+    all_clients = clients.values()
     if len(all_clients) > 0:
         return all_clients
     return None
 
 
+def find_clients_by_kind(kind):
+    '''
+    Find all existing clients of a kind
+
+    :param kind: KIND_BAG or KIND_WEB
+    :return: List containing all existing clients of that kind
+    '''
+    return clients.find_by_kind(kind)
+
+
 def get_client(ip, remote_host=None, wsHandler=None):
     '''
-    Find a client by IP. If there is no client with that IP, create a new one.
+    Find the client of a connection. If there is none, create a new one.
 
     :param ip: IP of client
+    :param remote_host: Host name the client connected with
+    :param wsHandler: Connection of the client
     :return: Client
     '''
-    # If client exists return it, otherwise create new client, add to list and
-    # return it (handled by dict.setdefault)
-    return clients.setdefault((ip, remote_host, wsHandler),
-                              Client(ip, remote_host, wsHandler))
+    return clients.get_or_create((ip, remote_host, wsHandler),
+                                 lambda: Client(ip, remote_host, wsHandler))
@@ -0,0 +1,216 @@
+import itertools
+import json
+import logging
+import os
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+import socket
+import client as client_module
+
+# Router of this worker process. None if the backend runs as one process.
+router = None
+
+
+class ClusterRouter(TCPServer):
+    '''
+    Routes messages between the worker processes of the backend. Every worker
+    listens on its own Unix socket. A message for a client that is not
+    connected to this worker is forwarded to all other workers, and the
+    worker holding the client delivers it. Every worker replies whether it
+    delivered the message, so the sender learns if no worker holds the
+    client. Messages are JSON, one per line.
+    '''
+    def __init__(self, worker_id, num_workers, socket_dir, timeout=2.0):
+        '''
+        Create the router of a worker
+
+        :param worker_id: Id of this worker, 0 to num_workers - 1
+        :param num_workers: Number of worker processes
+        :param socket_dir: Directory holding the Unix sockets of the workers
+        :param timeout: Seconds to wait for the replies of the other workers
+        :return: None
+        '''
+        TCPServer.__init__(self)
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.socket_dir = socket_dir
+        self.timeout = timeout
+        # Connected streams to the other workers, per worker id
+        self.peers = {}
+        # Forwarded messages waiting for replies, per route id, as
+        # [Future, workers that did not reply yet, timeout]
+        self.pending = {}
+        self.route_ids = itertools.count()
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.socket_dir, 'iot-worker-%d.sock' % worker_id)
+
+    def start_listening(self):
+        '''
+        Start accepting messages from the other workers.
+
+        :return: None
+        '''
+        self.add_socket(bind_unix_socket(self.socket_path(self.worker_id)))
+        logging.info('Worker %d routing on %s' %
+                     (self.worker_id, self.socket_path(self.worker_id)))
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        '''
+        Read the messages forwarded by another worker.
+
+        :param stream: Stream from the other worker
+        :param address: Address of the other worker
+        :return: None
+        '''
+        try:
+            while True:
+                line = yield stream.read_until(b'\n')
+                try:
+                    message = json.loads(line)
+                    if 'reply' in message:
+                        self.on_reply(message['reply'], message['delivered'])
+                        continue
+                    delivered = self.deliver(message)
+                    self.send_to_peer(message['origin'], json.dumps(
+                        {'reply': message['route'],
+                         'delivered': delivered}) + '\n')
+                except Exception as e:
+                    logging.exception('Worker %d: Failed to deliver routed ' %
+                                      self.worker_id + 'message: ' + str(e))
+        except StreamClosedError:
+            pass
+
+    def forward(self, target_ip, handler, msgtype, data):
+        '''
+        Forward a message for a client that is not connected to this worker
+        to all other workers.
+
+        :param target_ip: IP of the receiving client
+        :param handler: Handler, also the type of channel to send through
+        :param msgtype: Message type
+        :param data: Data of message
+        :return: Future, True once a worker delivered the message, False if
+         none did
+        '''
+        route_id = next(self.route_ids)
+        future = Future()
+        timeout = IOLoop.current().call_later(self.timeout, self.finish,
+                                              route_id, False)
+        self.pending[route_id] = [future, self.num_workers - 1, timeout]
+        line = json.dumps({'route': route_id,
+                           'origin': self.worker_id,
+                           'target': target_ip,
+                           'handler': handler,
+                           'command': msgtype,
+                           'data': data}) + '\n'
+        for worker_id in range(self.num_workers):
+            if worker_id != self.worker_id:
+                self.send_to_peer(worker_id, line).add_done_callback(
+                    lambda sent, route_id=route_id:
+                    sent.result() or self.on_reply(route_id, False))
+        return future
+
+    def on_reply(self, route_id, delivered):
+        '''
+        Count the reply of a worker to a forwarded message.
+
+        :param route_id: Route id of the message
+        :param delivered: Whether the worker delivered it
+        :return: None
+        '''
+        entry = self.pending.get(route_id)
+        if entry is None:
+            # Decided already, or timed out
+            return
+        entry[1] -= 1
+        if delivered or entry[1] == 0:
+            self.finish(route_id, delivered)
+
+    def finish(self, route_id, delivered):
+        entry = self.pending.pop(route_id, None)
+        if entry is None:
+            return
+        IOLoop.current().remove_timeout(entry[2])
+        entry[0].set_result(delivered)
+
+    @gen.coroutine
+    def send_to_peer(self, worker_id, line):
+        '''
+        Write a line to another worker, connecting to it first if needed.
+
+        :param worker_id: Id of the other worker
+        :param line: Encoded message
+        :return: True if written, False if the worker is not reachable
+        '''
+        try:
+            stream = self.peers.get(worker_id)
+            if stream is None or stream.closed():
+                stream = IOStream(socket.socket(socket.AF_UNIX,
+                                                socket.SOCK_STREAM))
+                self.peers[worker_id] = stream
+                # Writes are buffered until connected, which keeps them in
+                # order. A failed connect is reported by the pending write.
+                connecting = stream.connect(self.socket_path(worker_id))
+                connecting.add_done_callback(lambda future: future.exception())
+            yield stream.write(line)
+        except (StreamClosedError, socket.error) as e:
+            self.peers.pop(worker_id, None)
+            logging.warning('Worker %d: Can\'t route to worker %d: %s' %
+                            (self.worker_id, worker_id, str(e)))
+            raise gen.Return(False)
+        raise gen.Return(True)
+
+    def deliver(self, message):
+        '''
+        Deliver a message forwarded by another worker if the receiving client
+        is connected to this worker.
+
+        :param message: Forwarded message
+        :return: True if the message was sent to the client
+        '''
+        target = client_module.find_client(message['target'])
+        if target is None:
+            return False
+        channel = target.get_channel(message['handler'])
+        if channel is None:
+            return False
+        channel.send(message['handler'], message['command'], message['data'])
+        return True
+
+
+def route(target_ip, handler, msgtype, data):
+    '''
+    Send a message to a client connected to another worker, if the backend
+    runs with several workers.
+
+    :param target_ip: IP of the receiving client
+    :param handler: Handler, also the type of channel to send through
+    :param msgtype: Message type
+    :param data: Data of message
+    :return: Future, True once another worker delivered the message and
+     False if none did. None if there are no other workers
+    '''
+    if router is None:
+        return None
+    return router.forward(target_ip, handler, msgtype, data)
+
+
+def start(worker_id, num_workers, socket_dir, timeout=2.0):
+    '''
+    Start routing between workers for this worker process.
+
+    :param worker_id: Id of this worker
+    :param num_workers: Number of worker processes
+    :param socket_dir: Directory holding the Unix sockets of the workers
+    :param timeout: Seconds to wait for the other workers to reply
+    :return: None
+    '''
+    global router
+    router = ClusterRouter(worker_id, num_workers, socket_dir, timeout)
+    router.start_listening()
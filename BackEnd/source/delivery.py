@@ -0,0 +1,219 @@
+import collections
+import itertools
+import logging
+import tornado.ioloop
+import tornado.websocket
+
+# Message ids count up from 1000 and do not wrap within the 64-bit range
+# MessagePack and the JSON parsers of the clients handle, so an id is never
+# reused while a message with the same id may still be in flight.
+FIRST_ID = 1000
+MAX_ID = 2 ** 63 - 1
+message_ids = itertools.count(FIRST_ID)
+
+
+def next_id():
+    '''
+    Generate a message id, unique within this process.
+
+    :return: Id
+    '''
+    msgid = next(message_ids)
+    if msgid > MAX_ID:
+        raise OverflowError('Message id space exhausted')
+    return msgid
+
+
+class DeliveryWindow:
+    '''
+    Tracks the messages sent on a channel until the receiver acknowledges
+    them. At most window messages are unacknowledged at a time, the rest
+    waits here. A message that is not acknowledged within
+    retransmit_timeout seconds is sent again with the same id, with the
+    timeout doubled after every retry, and given up after max_retries
+    retries. The receiver drops the duplicates, see DuplicateFilter.
+    '''
+    def __init__(self, transmit, window=32, retransmit_timeout=2.0,
+                 max_retries=5, max_waiting=1000, ioloop=None):
+        '''
+        Create the delivery window of a channel
+
+        :param transmit: Function sending an encoded message, called with
+         handler, msgtype and the encoded message
+        :param window: Maximum number of unacknowledged messages
+        :param retransmit_timeout: Seconds before the first retransmission
+        :param max_retries: Retransmissions before a message is given up
+        :param max_waiting: Maximum number of messages waiting for room in
+         the window, the oldest is dropped beyond that
+        :param ioloop: IOLoop, the current one if None
+        :return: None
+        '''
+        self.transmit = transmit
+        self.window = window
+        self.retransmit_timeout = retransmit_timeout
+        self.max_retries = max_retries
+        self.max_waiting = max_waiting
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        # Unacknowledged messages per msgid, as
+        # [handler, command, encoded message, retries, timer]
+        self.in_flight = collections.OrderedDict()
+        # Messages waiting for room in the window, as
+        # (msgid, handler, command, encoded message)
+        self.waiting = collections.deque()
+        # Counters
+        self.acked = 0
+        self.retransmits = 0
+        self.expired = 0
+        self.dropped = 0
+
+    def send(self, msgid, handler, msgtype, message):
+        '''
+        Send a message that has to be acknowledged, or keep it until the
+        window has room.
+
+        :param msgid: Message id the receiver acknowledges
+        :param handler: Handler of the message
+        :param msgtype: Message type
+        :param message: Encoded message
+        :return: None
+        '''
+        if len(self.in_flight) < self.window:
+            self.in_flight[msgid] = [handler, msgtype, message, 0, None]
+            self.transmit_tracked(msgid)
+            return
+        if len(self.waiting) >= self.max_waiting:
+            self.waiting.popleft()
+            self.dropped += 1
+        self.waiting.append((msgid, handler, msgtype, message))
+
+    def transmit_tracked(self, msgid):
+        entry = self.in_flight[msgid]
+        entry[4] = self.ioloop.call_later(
+            self.retransmit_timeout * 2 ** entry[3], self.on_timeout, msgid)
+        self.transmit(entry[0], entry[1], entry[2])
+
+    def acknowledge(self, msgid):
+        '''
+        Handle the acknowledgement of a message.
+
+        :param msgid: Acknowledged message id
+        :return: False if the message was not in flight, e.g. a duplicate
+         acknowledgement, True otherwise
+        '''
+        entry = self.in_flight.pop(msgid, None)
+        if entry is None:
+            return False
+        self.ioloop.remove_timeout(entry[4])
+        self.acked += 1
+        self.fill()
+        return True
+
+    def on_timeout(self, msgid):
+        '''
+        Retransmit a message that was not acknowledged in time, or give it
+        up after max_retries.
+
+        :param msgid: Message id
+        :return: None
+        '''
+        entry = self.in_flight[msgid]
+        try:
+            if entry[3] >= self.max_retries:
+                del self.in_flight[msgid]
+                self.expired += 1
+                logging.warning('Message %d not acknowledged after %d ' %
+                                (msgid, entry[3]) + 'retransmissions, ' +
+                                'giving up')
+                self.fill()
+                return
+            entry[3] += 1
+            self.retransmits += 1
+            self.transmit_tracked(msgid)
+        except tornado.websocket.WebSocketClosedError:
+            self.clear()
+
+    def fill(self):
+        '''
+        Send waiting messages while the window has room.
+
+        :return: None
+        '''
+        while self.waiting and len(self.in_flight) < self.window:
+            self.send(*self.waiting.popleft())
+
+    def clear(self):
+        '''
+        Stop tracking all messages, after the channel closed.
+
+        :return: Number of messages that were not acknowledged
+        '''
+        for entry in self.in_flight.values():
+            if entry[4] is not None:
+                self.ioloop.remove_timeout(entry[4])
+        lost = len(self.in_flight) + len(self.waiting)
+        self.in_flight.clear()
+        self.waiting.clear()
+        return lost
+
+    def as_dict(self):
+        '''
+        Get the counters of the window.
+
+        :return: Dict with the counters
+        '''
+        return {'in_flight': len(self.in_flight),
+                'waiting': len(self.waiting),
+                'acked': self.acked,
+                'retransmits': self.retransmits,
+                'expired': self.expired,
+                'dropped': self.dropped}
+
+
+class DuplicateFilter:
+    '''
+    Remembers the ids of the last size messages received on a connection, to
+    drop retransmitted messages that were handled already.
+    '''
+    def __init__(self, size=1024):
+        self.size = size
+        self.reset()
+
+    def seen(self, msgid):
+        '''
+        Check a received message id, and remember it.
+
+        :param msgid: Message id
+        :return: True if the id was received before
+        '''
+        if msgid in self.ids:
+            return True
+        if len(self.order) >= self.size:
+            self.ids.discard(self.order.popleft())
+        self.order.append(msgid)
+        self.ids.add(msgid)
+        return False
+
+    def reset(self):
+        '''
+        Forget all ids, for a new connection.
+
+        :return: None
+        '''
+        self.ids = set()
+        self.order = collections.deque()
+
+
+def create_window(config, transmit):
+    '''
+    Create a delivery window with the settings of the [delivery] section.
+
+    :param config: Configuration
+    :param transmit: Function sending an encoded message
+    :return: DeliveryWindow
+    '''
+    return DeliveryWindow(
+        transmit,
+        window=config.getint('delivery', 'window'),
+        retransmit_timeout=config.getfloat('delivery', 'retransmit_timeout'),
+        max_retries=config.getint('delivery', 'max_retries'),
+        max_waiting=config.getint('delivery', 'max_waiting'))
@@ -0,0 +1,42 @@
+import serialization
+
+
+class EncodedMessage:
+    '''
+    A message whose handler, command and data are encoded once per codec.
+    Every receiver using that codec gets the same encoded body, only the
+    msgid in front of it is added per receiver, so a broadcast to many
+    channels does not encode the payload again for each of them.
+    '''
+    def __init__(self, handler, msgtype, data, etag=None):
+        '''
+        Create a message to be encoded
+
+        :param handler: Handler
+        :param msgtype: Message type
+        :param data: Data of message
+        :param etag: Version tag of the data, if it is a cached snapshot
+        :return: None
+        '''
+        self.handler = handler
+        self.msgtype = msgtype
+        self.data = data
+        # Encoded body per codec name
+        self.bodies = {}
+        self.etag = etag
+
+    def for_msgid(self, msgid, codec=None):
+        '''
+        Get the complete encoded message for a receiver.
+
+        :param msgid: Message Id for this receiver, or None
+        :param codec: Codec of the receiving channel, JSON if None
+        :return: Encoded message
+        '''
+        if codec is None:
+            codec = serialization.default_codec
+        body = self.bodies.get(codec.name)
+        if body is None:
+            body = codec.encode_body(self.handler, self.msgtype, self.data)
+            self.bodies[codec.name] = body
+        return codec.encode_envelope(msgid, body)
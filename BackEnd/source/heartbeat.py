@@ -0,0 +1,65 @@
+from tornado.ioloop import IOLoop
+
+
+class RoundTripTime:
+    '''
+    Round trip time of a websocket connection, measured with the keep-alive
+    pings. The average is smoothed like the TCP round trip time, so a single
+    slow pong does not make it jump.
+    '''
+    def __init__(self, alpha=0.125):
+        '''
+        Create an empty measurement
+
+        :param alpha: Weight of a new sample in the moving average
+        :return: None
+        '''
+        self.alpha = alpha
+        self.last = None
+        self.average = None
+        self.samples = 0
+
+    def observe(self, seconds):
+        self.last = seconds
+        if self.average is None:
+            self.average = seconds
+        else:
+            self.average += self.alpha * (seconds - self.average)
+        self.samples += 1
+
+    def observe_pong(self, protocol):
+        '''
+        Measure the time since the last ping of a websocket protocol, when
+        its pong arrived.
+
+        :param protocol: Websocket protocol that sent the ping
+        :return: Measured seconds, or None without a ping
+        '''
+        if protocol is None or not protocol.last_ping:
+            return None
+        seconds = max(0.0, IOLoop.current().time() - protocol.last_ping)
+        self.observe(seconds)
+        return seconds
+
+    def as_dict(self):
+        '''
+        Get the measurement.
+
+        :return: Dict with the last and average round trip time in seconds,
+         None before the first pong, and the number of samples
+        '''
+        return {'last': self.last,
+                'average': self.average,
+                'samples': self.samples}
+
+
+def ping_settings(config):
+    '''
+    Read the keep-alive settings of the [heartbeat] section.
+
+    :param config: Configuration
+    :return: (seconds between pings, seconds without pong before the
+     connection is closed), 0 as interval disables pings
+    '''
+    return (config.getfloat('heartbeat', 'ping_interval'),
+            config.getfloat('heartbeat', 'ping_timeout'))
@@ -0,0 +1,125 @@
+import logging
+import pprint
+import datetime
+
+
+class LazyPrettyFormat:
+    '''
+    Defer pretty printing of a payload until a log record is actually
+    emitted. Passed as an argument to the logging call instead of the result
+    of pprint.pformat.
+    '''
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return pprint.pformat(self.data)
+
+
+class Sampler:
+    '''
+    Let one in every N events through. With N <= 1 every event passes.
+    '''
+    def __init__(self, every=1):
+        self.every = max(1, every)
+        self.count = 0
+
+    def sample(self):
+        '''
+        Count an event and decide whether it is sampled.
+
+        :return: True if the event should be logged
+        '''
+        if self.every == 1:
+            return True
+        self.count += 1
+        if self.count >= self.every:
+            self.count = 0
+            return True
+        return False
+
+
+class MessageLogger:
+    '''
+    Logging of the per-message hot path. Level checks run before anything is
+    formatted, so records below the configured level cost a method call.
+    Records carry the message fields as structured attributes (msgid, handler,
+    command, peer) and can be sampled to log only one in N messages.
+    '''
+    def __init__(self, name='iot.messages', sample_every=1):
+        '''
+        Create a new message logger
+
+        :param name: Logger name, propagates to the root handlers
+        :param sample_every: Log only one in every sample_every messages
+        :return: None
+        '''
+        self.logger = logging.getLogger(name)
+        self.sampler = Sampler(sample_every)
+
+    def enabled(self):
+        '''
+        Check whether a message record would be emitted at all. Also counts
+        the message for sampling.
+
+        :return: True if the message should be logged
+        '''
+        return (self.logger.isEnabledFor(logging.INFO) and
+                self.sampler.sample())
+
+    def received(self, peer, channel_id, handler, msgid, msgtype, data):
+        '''
+        Log an incoming message.
+
+        :param peer: Sender, e.g. IP of client
+        :param channel_id: Id of channel, None if not applicable
+        :param handler: Handler
+        :param msgid: Message Id
+        :param msgtype: Message type
+        :param data: Data of message
+        :return: None
+        '''
+        if not self.enabled():
+            return
+        self.log('Receiving from', '>>>Receiving<<<', 'sender', peer,
+                 channel_id, handler, msgid, msgtype, data)
+
+    def sent(self, peer, channel_id, handler, msgid, msgtype, message):
+        '''
+        Log an outgoing message.
+
+        :param peer: Receiver, e.g. IP of client
+        :param channel_id: Id of channel, None if not applicable
+        :param handler: Handler
+        :param msgid: Message Id
+        :param msgtype: Message type
+        :param message: Message
+        :return: None
+        '''
+        if not self.enabled():
+            return
+        self.log('Sending to', '>>>Sending<<<', 'receiver', peer,
+                 channel_id, handler, msgid, msgtype, message)
+
+    def log(self, direction, title, role, peer, channel_id, handler, msgid,
+            msgtype, data):
+        '''
+        Emit the summary record and, at debug level, the full payload.
+        '''
+        extra = {'peer': peer, 'channel_id': channel_id, 'handler': handler,
+                 'msgid': msgid, 'command': msgtype}
+        self.logger.info('%s | %s %s - msgid: %s, handler: %s, command: %s',
+                         datetime.datetime.now(), direction, peer, msgid,
+                         handler, msgtype, extra=extra)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                '%s\n'
+                '\t%s:\t\t%s\n'
+                '\tchannelid:\t%s\n'
+                '\thandler:\t%s\n\tmessage id:\t%s\n'
+                '\tmessagetype:\t%s\n'
+                '\t=============================================\n'
+                '\t%s\n'
+                '\t=============================================',
+                title, role, peer, channel_id, handler, msgid, msgtype,
+                LazyPrettyFormat(data), extra=extra)
@@ -0,0 +1,142 @@
+import bisect
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BOUNDS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                  1.0, 2.5, 5.0, 10.0]
+
+# Objects with a collect(writer) method, rendered by the /metrics route
+collectors = []
+
+
+class Histogram:
+    '''
+    Counts observed values in fixed buckets. Observing is one bisect on the
+    bucket bounds, so it is cheap enough for every message, and quantiles
+    are estimated from the buckets when they are read.
+    '''
+    def __init__(self, bounds=None):
+        if bounds is None:
+            bounds = DEFAULT_BOUNDS
+        self.bounds = bounds
+        # Count per bucket, the last one for values above all bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        '''
+        Estimate a quantile, interpolating linearly within its bucket.
+
+        :param q: Quantile, e.g. 0.99
+        :return: Estimated value, 0 if nothing was observed
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank:
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                if index == len(self.bounds):
+                    # Above the last bound, the best estimate is that bound
+                    return lower
+                upper = self.bounds[index]
+                return lower + ((upper - lower) * (rank - cumulative) /
+                                bucket_count)
+            cumulative += bucket_count
+        return self.bounds[-1]
+
+
+class MetricsWriter:
+    '''
+    Builds a page in the Prometheus text exposition format.
+    '''
+    def __init__(self):
+        self.lines = []
+
+    def header(self, name, kind, description):
+        '''
+        Start a metric. All its samples must follow before the next header.
+
+        :param name: Metric name
+        :param kind: counter, gauge, histogram or summary
+        :param description: Help text
+        :return: None
+        '''
+        self.lines.append('# HELP %s %s' % (name, description))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+
+    def sample(self, name, labels, value):
+        '''
+        Add a sample.
+
+        :param name: Metric name, with suffix like _bucket if any
+        :param labels: List of (label, value) pairs
+        :param value: Value
+        :return: None
+        '''
+        if labels:
+            name += '{%s}' % ','.join(['%s="%s"' % (label, escape(label_value))
+                                       for label, label_value in labels])
+        self.lines.append('%s %s' % (name, format_value(value)))
+
+    def histogram(self, name, labels, histogram):
+        '''
+        Add the buckets, sum and count of a histogram.
+
+        :param name: Metric name
+        :param labels: List of (label, value) pairs
+        :param histogram: Histogram
+        :return: None
+        '''
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.bounds, histogram.counts):
+            cumulative += bucket_count
+            self.sample(name + '_bucket', labels + [('le', '%g' % bound)],
+                        cumulative)
+        self.sample(name + '_bucket', labels + [('le', '+Inf')],
+                    histogram.count)
+        self.sample(name + '_sum', labels, histogram.sum)
+        self.sample(name + '_count', labels, histogram.count)
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def escape(label_value):
+    return str(label_value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def register(collector):
+    '''
+    Add a collector to the /metrics page.
+
+    :param collector: Object with a collect(writer) method
+    :return: None
+    '''
+    collectors.append(collector)
+
+
+def render():
+    '''
+    Collect all metrics.
+
+    :return: Page in the Prometheus text exposition format
+    '''
+    writer = MetricsWriter()
+    for collector in collectors:
+        collector.collect(writer)
+    return writer.text()
@@ -0,0 +1,255 @@
+import collections
+import logging
+import time
+import tornado.ioloop
+import tornado.websocket
+
+# What a full queue does with a new message
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_CONFLATE = 'conflate'
+POLICY_DISCONNECT = 'disconnect'
+policies = [POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_CONFLATE,
+            POLICY_DISCONNECT]
+
+
+class OutboundQueue:
+    '''
+    Bounded queue of the messages to send on one channel. At most
+    write_window messages are handed to the connection without being flushed
+    to the network, the rest waits here. When max_size messages are waiting,
+    the policy decides what happens to a new one:
+
+    - block: the message waits for room for up to block_timeout seconds and
+      is dropped after that. The IOLoop itself can not be blocked. When
+      max_blocked messages are waiting for room the channel is closed as
+      with disconnect.
+    - drop_oldest: the oldest waiting message is dropped.
+    - conflate: a waiting message with the same handler and command is
+      replaced by the new one, otherwise the oldest one is dropped.
+    - disconnect: the channel is closed and everything waiting is dropped.
+
+    So a slow or stalled client holds at most max_size encoded messages in
+    the backend, instead of an ever growing write buffer.
+    '''
+    def __init__(self, write, close, policy=POLICY_DROP_OLDEST, max_size=1000,
+                 write_window=16, block_timeout=5.0, max_blocked=1000,
+                 ioloop=None):
+        '''
+        Create the queue of a channel
+
+        :param write: Function writing an encoded message to the connection,
+         returning a Future that is done when it is flushed, or None
+        :param close: Function closing the connection
+        :param policy: What to do when the queue is full, one of policies
+        :param max_size: Maximum number of waiting messages
+        :param write_window: Maximum number of unflushed messages handed to
+         the connection
+        :param block_timeout: Seconds a message may wait for room with the
+         block policy
+        :param max_blocked: Maximum number of messages waiting for room with
+         the block policy
+        :param ioloop: IOLoop, the current one if None
+        :return: None
+        '''
+        if policy not in policies:
+            raise ValueError('Unknown outbound policy "%s"' % policy)
+        self.write = write
+        self.close = close
+        self.policy = policy
+        self.max_size = max_size
+        self.write_window = write_window
+        self.block_timeout = block_timeout
+        self.max_blocked = max_blocked
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        # Waiting messages as (handler, command, encoded message)
+        self.queue = collections.deque()
+        # Messages waiting for room with the block policy, as
+        # (deadline, handler, command, encoded message)
+        self.blocked = collections.deque()
+        self.block_timer = None
+        self.in_flight = 0
+        self.closed = False
+        # Counters
+        self.sent = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.max_depth = 0
+
+    def put(self, handler, msgtype, message):
+        '''
+        Send an encoded message, or queue it if the connection has enough
+        unflushed messages already.
+
+        :param handler: Handler of the message
+        :param msgtype: Message type, with handler used to conflate
+        :param message: Encoded message
+        :return: False if the message was dropped, True otherwise
+        '''
+        if self.closed:
+            self.dropped += 1
+            return False
+        if self.in_flight < self.write_window and not self.queue:
+            self.write_now(message)
+            return True
+        if len(self.queue) < self.max_size:
+            self.enqueue(handler, msgtype, message)
+            return True
+        return self.overflow(handler, msgtype, message)
+
+    def enqueue(self, handler, msgtype, message):
+        self.queue.append((handler, msgtype, message))
+        if self.depth() > self.max_depth:
+            self.max_depth = self.depth()
+
+    def overflow(self, handler, msgtype, message):
+        '''
+        Apply the policy to a message arriving at a full queue.
+
+        :return: False if the new message was dropped, True otherwise
+        '''
+        if self.policy == POLICY_BLOCK:
+            if len(self.blocked) >= self.max_blocked:
+                return self.disconnect()
+            self.blocked.append((time.time() + self.block_timeout, handler,
+                                 msgtype, message))
+            if self.block_timer is None:
+                self.block_timer = self.ioloop.call_later(
+                    self.block_timeout, self.expire_blocked)
+            return True
+        if self.policy == POLICY_DISCONNECT:
+            return self.disconnect()
+        if self.policy == POLICY_CONFLATE:
+            for index, (q_handler, q_msgtype, _) in enumerate(self.queue):
+                if q_handler == handler and q_msgtype == msgtype:
+                    # Keep the place in the queue, but with the newest data
+                    self.queue[index] = (handler, msgtype, message)
+                    self.conflated += 1
+                    return True
+        self.queue.popleft()
+        self.dropped += 1
+        self.enqueue(handler, msgtype, message)
+        return True
+
+    def disconnect(self):
+        '''
+        Drop a message arriving at a full queue together with everything
+        waiting, and close the channel.
+
+        :return: False
+        '''
+        logging.warning('Outbound queue full, closing the channel')
+        self.dropped += 1
+        self.clear()
+        self.close()
+        return False
+
+    def expire_blocked(self):
+        '''
+        Drop the blocked messages that waited longer than block_timeout.
+
+        :return: None
+        '''
+        self.block_timer = None
+        now = time.time()
+        while self.blocked and self.blocked[0][0] <= now:
+            self.blocked.popleft()
+            self.dropped += 1
+        if self.blocked:
+            self.block_timer = self.ioloop.call_later(
+                self.blocked[0][0] - now, self.expire_blocked)
+
+    def write_now(self, message):
+        self.in_flight += 1
+        future = None
+        try:
+            future = self.write(message)
+        finally:
+            if future is None:
+                self.in_flight -= 1
+        self.sent += 1
+        if future is not None:
+            future.add_done_callback(self.on_write_done)
+
+    def on_write_done(self, future):
+        '''
+        Called when a write has been flushed to the network or failed. Hand
+        the next waiting messages to the connection.
+
+        :param future: Result of the write
+        :return: None
+        '''
+        self.in_flight -= 1
+        try:
+            self.flush()
+        except tornado.websocket.WebSocketClosedError:
+            self.clear()
+
+    def flush(self):
+        '''
+        Write waiting messages while the write window has room, and move
+        blocked messages into the freed places of the queue.
+
+        :return: None
+        '''
+        while True:
+            while self.blocked and len(self.queue) < self.max_size:
+                self.enqueue(*self.blocked.popleft()[1:])
+            if not self.queue or self.in_flight >= self.write_window:
+                return
+            self.write_now(self.queue.popleft()[2])
+
+    def clear(self):
+        '''
+        Drop everything waiting, after the channel closed.
+
+        :return: None
+        '''
+        self.closed = True
+        self.dropped += len(self.queue) + len(self.blocked)
+        self.queue.clear()
+        self.blocked.clear()
+        if self.block_timer is not None:
+            self.ioloop.remove_timeout(self.block_timer)
+            self.block_timer = None
+
+    def depth(self):
+        '''
+        Get the number of messages not flushed to the network yet.
+
+        :return: Unflushed and waiting messages
+        '''
+        return self.in_flight + len(self.queue) + len(self.blocked)
+
+    def as_dict(self):
+        '''
+        Get the counters of the queue.
+
+        :return: Dict with the counters
+        '''
+        return {'policy': self.policy,
+                'depth': self.depth(),
+                'max_depth': self.max_depth,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'conflated': self.conflated}
+
+
+def create_queue(config, write, close):
+    '''
+    Create an outbound queue with the settings of the [outbound] section.
+
+    :param config: Configuration
+    :param write: Function writing an encoded message to the connection
+    :param close: Function closing the connection
+    :return: OutboundQueue
+    '''
+    return OutboundQueue(write, close,
+                         policy=config.get('outbound', 'policy'),
+                         max_size=config.getint('outbound', 'max_size'),
+                         write_window=config.getint('outbound',
+                                                    'write_window'),
+                         block_timeout=config.getfloat('outbound',
+                                                       'block_timeout'),
+                         max_blocked=config.getint('outbound',
+                                                   'max_blocked'))
@@ -0,0 +1,79 @@
+import logging
+from collections import OrderedDict
+import client as client_module
+from envelope import EncodedMessage
+
+
+def presence_entry(target):
+    '''
+    Describe a client in a presence snapshot or event.
+
+    :param target: Client
+    :return: Dict describing the client
+    '''
+    return {'ip': target.ip,
+            'name': target.name,
+            'host': target.host,
+            'kind': target.kind,
+            'id': target.id}
+
+
+class PresenceHub:
+    '''
+    Pushes join, leave and rename events of clients to the clients that
+    subscribed to presence, so dashboards do not have to poll the full
+    client listing. Each event is encoded once for all subscribers.
+    '''
+    def __init__(self):
+        # Subscribed clients per client key
+        self.subscribers = OrderedDict()
+
+    def subscribe(self, subscriber):
+        '''
+        Subscribe a client to presence events.
+
+        :param subscriber: Client
+        :return: Snapshot of the currently available clients
+        '''
+        self.subscribers[subscriber.key] = subscriber
+        return {'clients': [presence_entry(target) for target in
+                            client_module.clients.values()
+                            if len(target.channels) != 0]}
+
+    def unsubscribe(self, subscriber):
+        '''
+        Stop sending presence events to a client.
+
+        :param subscriber: Client
+        :return: None
+        '''
+        self.subscribers.pop(subscriber.key, None)
+
+    def publish(self, event, target):
+        '''
+        Send a presence event to all subscribers.
+
+        :param event: client.PRESENCE_JOIN, PRESENCE_LEAVE or PRESENCE_RENAME
+        :param target: Client the event is about
+        :return: None
+        '''
+        if event == client_module.PRESENCE_LEAVE:
+            self.unsubscribe(target)
+        if not self.subscribers:
+            return
+        encoded = EncodedMessage('control', 'presence',
+                                 {'event': event,
+                                  'client': presence_entry(target)})
+        for subscriber in self.subscribers.values():
+            channel = subscriber.get_channel('control')
+            if channel is None:
+                continue
+            try:
+                channel.send_encoded(encoded)
+            except Exception as e:
+                logging.warning('Presence event for %s not sent: %s' %
+                                (subscriber.ip, str(e)))
+
+
+hub = PresenceHub()
+client_module.presence_listeners.append(hub.publish)
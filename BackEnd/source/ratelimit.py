@@ -0,0 +1,61 @@
+class TokenBucket:
+    '''
+    Token bucket rate limit: up to burst events at once, refilled at rate
+    events per second. Time is passed in, so one clock reading can serve
+    several buckets.
+    '''
+    def __init__(self, rate, burst, now):
+        '''
+        Create a full bucket
+
+        :param rate: Tokens added per second
+        :param burst: Maximum number of tokens
+        :param now: Current time in seconds
+        :return: None
+        '''
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now, tokens=1):
+        '''
+        Take tokens from the bucket if there are enough.
+
+        :param now: Current time in seconds
+        :param tokens: Number of tokens needed
+        :return: 0 if the tokens were taken, otherwise the seconds until
+         there are enough
+        '''
+        self.refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0
+        if self.rate <= 0:
+            return float('inf')
+        return (tokens - self.tokens) / self.rate
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+def create_bucket(config, section, prefix, now):
+    '''
+    Create a token bucket with the <prefix>_rate and <prefix>_burst settings
+    of a config section.
+
+    :param config: Configuration
+    :param section: Config section, e.g. 'inbound'
+    :param prefix: Prefix of the settings, e.g. 'channel'
+    :param now: Current time in seconds
+    :return: TokenBucket
+    '''
+    return TokenBucket(config.getfloat(section, prefix + '_rate'),
+                       config.getint(section, prefix + '_burst'), now)
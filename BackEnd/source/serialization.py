@@ -0,0 +1,176 @@
+import json
+import logging
+from json_stream import StackedJSONDecoder
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Subprotocol tokens that request a codec, e.g. 'iot.msgpack'
+SUBPROTOCOL_PREFIX = 'iot.'
+
+
+class JSONCodec:
+    '''
+    JSON text frames. Always available and used when no other codec was
+    negotiated.
+    '''
+    name = 'json'
+    binary = False
+
+    def encode(self, obj):
+        '''
+        Encode a complete message.
+
+        :param obj: Message
+        :return: Encoded message
+        '''
+        return json.dumps(obj)
+
+    def encode_body(self, handler, msgtype, data):
+        '''
+        Encode everything of a message except the msgid, so the result can be
+        shared between receivers.
+
+        :param handler: Handler
+        :param msgtype: Message type
+        :param data: Data of message
+        :return: Encoded body
+        '''
+        return ', "handler": %s, "command": %s, "data": %s}' % (
+            json.dumps(handler), json.dumps(msgtype), json.dumps(data))
+
+    def encode_envelope(self, msgid, body):
+        '''
+        Put the msgid in front of an encoded body.
+
+        :param msgid: Message Id, or None
+        :param body: Result of encode_body
+        :return: Encoded message
+        '''
+        if msgid is None:
+            return '{"msgid": null' + body
+        return '{"msgid": %d%s' % (msgid, body)
+
+    def decoder(self, max_size=1048576):
+        '''
+        Create a streaming decoder for the frames of one channel.
+
+        :param max_size: Maximum size of one message
+        :return: Object with feed(data) and reset()
+        '''
+        return StackedJSONDecoder(max_size=max_size)
+
+
+class MessagePackDecoder:
+    '''
+    Decoder for stacked MessagePack messages, with the same interface as
+    StackedJSONDecoder: feed yields every message of a frame and None for
+    malformed data. Nothing is kept between frames.
+    '''
+    def __init__(self, max_size=1048576):
+        self.max_size = max_size
+
+    def feed(self, data):
+        '''
+        Decode all messages in a frame. A websocket frame is always a whole
+        message, so a message still incomplete at the end of the frame is
+        malformed.
+
+        :param data: Received frame
+        :return: Generator of decoded messages
+        '''
+        unpacker = msgpack.Unpacker(raw=False, max_buffer_size=self.max_size)
+        # End of the last complete message. tell() of the C unpacker also
+        # counts the bytes of a message it could only partly read
+        end = 0
+        try:
+            unpacker.feed(data)
+            for message in unpacker:
+                end = unpacker.tell()
+                yield message
+        except (ValueError, msgpack.BufferFull):
+            # The unpacker can not resynchronise after malformed data
+            yield None
+            return
+        if end < len(data):
+            yield None
+
+    def reset(self):
+        '''
+        Nothing is buffered between frames.
+
+        :return: None
+        '''
+        pass
+
+
+class MessagePackCodec:
+    '''
+    MessagePack binary frames. Smaller and cheaper to parse than JSON, which
+    matters on the radio link of the bags. Needs the msgpack package.
+
+    A MessagePack map is its header followed by the packed keys and values,
+    so the body can be packed once and the msgid prepended per receiver.
+    '''
+    name = 'msgpack'
+    binary = True
+
+    # See JSONCodec for the description of the methods
+    def encode(self, obj):
+        # Strings are packed as the str type, which every MessagePack
+        # implementation decodes to text. There is no binary data in messages
+        return msgpack.packb(obj, use_bin_type=False)
+
+    def encode_body(self, handler, msgtype, data):
+        return b''.join([self.encode(value) for value in [
+            'handler', handler, 'command', msgtype, 'data', data]])
+
+    def encode_envelope(self, msgid, body):
+        # 0x84 is a fixmap header with four entries
+        return b'\x84' + self.encode('msgid') + self.encode(msgid) + body
+
+    def decoder(self, max_size=1048576):
+        return MessagePackDecoder(max_size=max_size)
+
+
+default_codec = JSONCodec()
+codecs = {default_codec.name: default_codec}
+if msgpack is not None:
+    codecs[MessagePackCodec.name] = MessagePackCodec()
+
+
+def get_codec(name):
+    '''
+    Get a codec by name.
+
+    :param name: Codec name, e.g. 'json' or 'msgpack'
+    :return: Codec, or None if it is unknown or its package is missing
+    '''
+    codec = codecs.get(name.strip())
+    if codec is None:
+        logging.warning('Codec %s is not available' % name)
+    return codec
+
+
+def subprotocol_for(codec):
+    '''
+    Get the subprotocol token that requests a codec.
+
+    :param codec: Codec
+    :return: Subprotocol token
+    '''
+    return SUBPROTOCOL_PREFIX + codec.name
+
+
+def codec_for_subprotocol(subprotocol):
+    '''
+    Get the codec requested by a subprotocol token.
+
+    :param subprotocol: Subprotocol token
+    :return: Codec, or None if the token does not request a codec
+    '''
+    if subprotocol is None or not subprotocol.startswith(SUBPROTOCOL_PREFIX):
+        return None
+    return codecs.get(subprotocol[len(SUBPROTOCOL_PREFIX):])
@@ -3,6 +3,8 @@ import tornado.httpserver
 import tornado.websocket
 import tornado.ioloop
 import tornado.web
+import tornado.netutil
+import tornado.process
 import logging
 from logging.handlers import RotatingFileHandler
 import sys
@@ -10,6 +12,8 @@ import signal
 import os
 from config_handler import config
 from daemon import Daemon
+import cluster
+import heartbeat
 
 
 def setup_logging():
@@ -85,6 +89,21 @@ def setup_signal_handling():
     signal.signal(signal.SIGTERM, signal_handler)
 
 
+def stop_workers(signum, frame):
+    '''
+    Handle shutdown of the parent process of the workers, by passing the
+    signal on to the workers in its process group.
+
+    :param signum: signal
+    :param frame: frame
+    :return: None
+    '''
+    logging.info("Stopping workers")
+    signal.signal(signum, signal.SIG_IGN)
+    os.killpg(0, signum)
+    sys.exit(0)
+
+
 def setup_database():
     '''
     Do preparation work on the database.
@@ -101,18 +120,28 @@ def setup_server():
     :return: None
     '''
     from APIs.websocketHandler import WebsocketAPIHandler
+    from APIs.metricsHandler import MetricsHandler
+    from APIs.httpHandler import HttpAPIHandler
+
+    ping_interval, ping_timeout = heartbeat.ping_settings(config)
 
     http_server = tornado.httpserver.HTTPServer(
         tornado.web.Application([
             ('/API-ws/(.*)', WebsocketAPIHandler),
-            # ('/API-http/(.*)', HttpAPIHandler),
+            ('/metrics', MetricsHandler),
+            ('/API-http/(.*)', HttpAPIHandler),
             # # Below are features useful during development
             # ('/APItestSuite/(.*)', tornado.web.StaticFileHandler,
             #  {'path': 'test_tools/webinterface',
             #   'default_filename': 'index.html'}),
             # ('/coverage/(.*)', tornado.web.StaticFileHandler,
             #     {'path': 'htmlcov', 'default_filename': 'index.html'})
-        ]))
+        ], websocket_max_message_size=config.getint('inbound',
+                                                    'max_frame_size'),
+           websocket_ping_interval=ping_interval,
+           websocket_ping_timeout=ping_timeout),
+        idle_connection_timeout=config.getint('server',
+                                              'http_idle_timeout'))
     return http_server
 
 
@@ -129,15 +158,35 @@ class Backend:
         setup_logging()
         setup_signal_handling()
         setup_database()
-        http_server = setup_server()
 
-        # Start servers
+        workers = config.getint('server', 'workers')
+        if workers != 1:
+            # Prefork: the workers share the listen socket, and route
+            # messages for clients held by another worker to each other
+            sockets = tornado.netutil.bind_sockets(
+                config.getint('server', 'webport'))
+            signal.signal(signal.SIGINT, stop_workers)
+            signal.signal(signal.SIGTERM, stop_workers)
+            if workers == 0:
+                workers = tornado.process.cpu_count()
+            logging.info("Starting %d workers" % workers)
+            worker_id = tornado.process.fork_processes(workers)
+            setup_signal_handling()
+
+            cluster.start(worker_id, workers,
+                          config.get('server', 'worker_socket_dir'),
+                          config.getfloat('server', 'worker_route_timeout'))
+            http_server = setup_server()
+            http_server.add_sockets(sockets)
+            logging.info("Launching Websocket listener, worker %d" %
+                         worker_id)
+        else:
+            http_server = setup_server()
+            http_server.listen(config.get('server',  'webport'))
+            logging.info("Launching Websocket listener")
 
-        # Prepare HTTP server
+        # Start servers
         ioloop = tornado.ioloop.IOLoop.instance()
-
-        http_server.listen(config.get('server',  'webport'))
-        logging.info("Launching Websocket listener")
         ioloop.start()
 
 
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+Benchmark for sending one response to many receivers.
+
+Compares encoding the complete message for every receiver, as the former
+BaseConnectionHandler.send did, with encoding it once and only adding the
+msgid per receiver. Channels discard the written data, so only the cost of
+the fan-out path itself is measured.
+
+Run from the BackEnd directory:
+    python test_tools/bench_broadcast.py
+'''
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'source'))
+from APIs.baseConnectionHandler import BaseConnectionHandler
+
+MESSAGE = {'tags': [{'id': i, 'name': 'Tag %d' % i,
+                     'mac': '5C:E8:EB:7B:87:%02d' % i} for i in range(10)]}
+
+
+class DiscardingChannel(BaseConnectionHandler):
+    def __init__(self, channel_id):
+        self.setup()
+        self.ip = '10.10.40.%d' % (channel_id % 256)
+        self.id = channel_id
+        self.written = 0
+
+    def write_message(self, message, binary=False):
+        self.written += len(message)
+
+
+class Receiver:
+    def __init__(self, channel):
+        self.ws = channel
+        self.channel = channel
+
+    def get_channel(self, channel_type):
+        return self.channel
+
+
+def legacy_broadcast(origin, receivers):
+    for r in receivers:
+        channel = r.get_channel('control')
+        channel.write_message(json.dumps({
+            'msgid': channel.generate_id(),
+            'handler': 'control',
+            'command': 'track_articles',
+            'data': MESSAGE
+        }))
+
+
+def encode_once_broadcast(origin, receivers):
+    origin.broadcast(receivers, 'control', 'track_articles', MESSAGE)
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    origin = DiscardingChannel(0)
+    print('%9s | %16s | %16s' % ('receivers', 'legacy ms', 'encode once ms'))
+    for count in [1000, 10000]:
+        receivers = [Receiver(DiscardingChannel(i + 1))
+                     for i in range(count)]
+        timings = []
+        for func in [legacy_broadcast, encode_once_broadcast]:
+            start = time.time()
+            func(origin, receivers)
+            timings.append((time.time() - start) * 1e3)
+        print('%9d | %16.2f | %16.2f' % (count, timings[0], timings[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+'''
+Benchmark comparing the wire codecs on typical messages: encoded size and
+the CPU time to encode and to decode one message. Codecs whose package is
+not installed are skipped.
+
+Run from the BackEnd directory:
+    python test_tools/bench_codecs.py
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'source'))
+import serialization
+
+ITERATIONS = 5000
+MESSAGES = [
+    ('print_message', {
+        'msgid': 1001, 'handler': 'control', 'command': 'print_message',
+        'data': {'sender': '10.10.40.4', 'line1': 'Alert!',
+                 'line2': 'Missing item', 'is_error': True}}),
+    ('track_articles', {
+        'msgid': 1002, 'handler': 'control', 'command': 'track_articles',
+        'data': {'tags': [{'id': i, 'name': 'Tag %d' % i,
+                           'mac': '5C:E8:EB:7B:87:%02d' % i}
+                          for i in range(20)]}}),
+    ('available_clients', {
+        'msgid': 1003, 'handler': 'control', 'command': 'available_clients',
+        'data': {'clients': [{'ip': '10.10.%d.%d' % (i // 256, i % 256),
+                              'name': 'SB%d' % i, 'host': 'SB%d' % i,
+                              'trusted_ip': True, 'id': -1}
+                             for i in range(100)]}}),
+]
+
+
+def per_message_us(func):
+    start = time.time()
+    for _ in range(ITERATIONS):
+        func()
+    return (time.time() - start) * 1e6 / ITERATIONS
+
+
+def main():
+    print('%-18s %-8s | %8s | %11s | %11s' %
+          ('message', 'codec', 'bytes', 'encode us', 'decode us'))
+    for name, message in MESSAGES:
+        for codec_name in sorted(serialization.codecs):
+            codec = serialization.codecs[codec_name]
+            encoded = codec.encode(message)
+            encode_time = per_message_us(lambda: codec.encode(message))
+            decoder = codec.decoder()
+            decode_time = per_message_us(lambda: list(decoder.feed(encoded)))
+            print('%-18s %-8s | %8d | %11.2f | %11.2f' %
+                  (name, codec_name, len(encoded), encode_time, decode_time))
+    if serialization.msgpack is None:
+        print('msgpack is not installed, only json was measured')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+'''
+Soak benchmark for the client registry lifecycle.
+
+Runs many connect/disconnect cycles through the same calls as a websocket
+connection: the client is looked up or created, gets a channel, sets its
+channel mode and name, and the channel closes again. A fixed population of
+clients stays connected meanwhile. At every checkpoint the registry size,
+the number of live objects, the resident memory and the latency of a
+lookup by name are printed, all of which should stay flat.
+
+Run from the BackEnd directory:
+    python test_tools/bench_lifecycle.py [cycles]
+'''
+import gc
+import logging
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'source'))
+import client
+from APIs.baseConnectionHandler import BaseConnectionHandler
+
+POPULATION = 1000
+CHECKPOINTS = 10
+LOOKUPS = 10000
+
+
+class FakeChannel(BaseConnectionHandler):
+    def __init__(self, ip):
+        self.setup()
+        self.ip = ip
+
+    def write_message(self, message, binary=False):
+        pass
+
+    def connect(self, remote_host, name):
+        self.client = client.get_client(self.ip, remote_host, self)
+        self.id = self.client.add_channel(self)
+        self.client.set_channeltype(self.id, 'control')
+        self.client.set_name(name)
+
+
+def resident_kb():
+    '''
+    Current resident memory, or the peak where /proc is not available.
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def lookup_us():
+    start = time.time()
+    for i in range(LOOKUPS):
+        client.find_client_by_name('SB%d' % (i % POPULATION))
+    return (time.time() - start) * 1e6 / LOOKUPS
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    population = []
+    for i in range(POPULATION):
+        channel = FakeChannel('10.10.%d.%d' % (i // 256, i % 256))
+        channel.connect('host%d' % i, 'SB%d' % i)
+        population.append(channel)
+
+    print('%9s | %8s | %8s | %10s | %10s | %9s' %
+          ('cycles', 'clients', 'indexed', 'objects', 'rss KB',
+           'lookup us'))
+    step = max(1, cycles // CHECKPOINTS)
+    start = time.time()
+    for cycle in range(cycles + 1):
+        if cycle % step == 0:
+            gc.collect()
+            print('%9d | %8d | %8d | %10d | %10d | %9.2f' %
+                  (cycle, len(client.clients), len(client.clients.indexed),
+                   len(gc.get_objects()), resident_kb(), lookup_us()))
+        if cycle == cycles:
+            break
+        channel = FakeChannel('192.168.%d.%d' % (cycle // 256 % 256,
+                                                 cycle % 256))
+        # Named after connecting, as bags do with setchannelmode
+        channel.connect('transient', 'SBT%d' % cycle)
+        channel.on_close()
+    elapsed = time.time() - start
+    print('%d cycles in %.2f s, %.1f us per cycle' %
+          (cycles, elapsed, elapsed * 1e6 / max(1, cycles)))
+
+
+if __name__ == '__main__':
+    main()
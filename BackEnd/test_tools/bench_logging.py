@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+Microbenchmark for the logging done on every incoming and outgoing message.
+
+Compares the former eager formatting (pprint.pformat and string building on
+every message) with the lazily formatted MessageLogger, at INFO level where
+the debug dump of the payload is discarded. Records are written to
+/dev/null so only the formatting cost is measured.
+
+Run from the BackEnd directory:
+    python test_tools/bench_logging.py
+'''
+import datetime
+import logging
+import os
+import pprint
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'source'))
+from message_log import MessageLogger
+
+ITERATIONS = 20000
+MESSAGE = {'msgid': 1000,
+           'handler': 'control',
+           'command': 'track_articles',
+           'data': {'tags': [{'id': i, 'name': 'Tag %d' % i,
+                              'mac': '5C:E8:EB:7B:87:%02d' % i}
+                             for i in range(10)]}}
+
+
+def legacy_send_logging(ip, channel_id, handler, respond_id, msgtype,
+                        message):
+    '''
+    Former logging block of BaseConnectionHandler.send
+    '''
+    logging.info(
+        '%s | Sending to %s - msgid: %s, handler: %s, command: %s' %
+        (str(datetime.datetime.now()),
+         ip, respond_id, handler, msgtype))
+    ppmessage = pprint.pformat(message)
+    logging.debug(
+        '>>>Sending<<<\n' +
+        '\treceiver:\t\t%s\n' % ip +
+        '\tchannelid:\t%d\n' % channel_id +
+        '\thandler:\t%s\n\tmessage id:\t%d\n' % (handler, respond_id) +
+        '\tmessagetype:\t%s\n' % (msgtype) +
+        '\t=============================================\n'
+        '\t%s\n' % str(ppmessage) +
+        '\t=============================================')
+
+
+def measure(func):
+    start = time.time()
+    for _ in range(ITERATIONS):
+        func('10.10.40.3', 1, 'control', 1000, 'track_articles', MESSAGE)
+    return (time.time() - start) * 1e6 / ITERATIONS
+
+
+def main():
+    root = logging.getLogger()
+    root.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+
+    cases = [('legacy', legacy_send_logging),
+             ('lazy', MessageLogger().sent),
+             ('lazy, 1 in 100 sampled', MessageLogger(sample_every=100).sent)]
+    for level in [logging.DEBUG, logging.INFO, logging.WARNING]:
+        root.setLevel(level)
+        print('Level %s' % logging.getLevelName(level))
+        for name, func in cases:
+            print('  %-24s %8.2f us/msg' % (name, measure(func)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+'''
+Benchmark for decoding frames that hold many stacked JSON messages.
+
+Compares the former regex based splitter with the streaming decoder for
+frames holding 1 to 10,000 messages. The time per message of the streaming
+decoder should stay flat while the frame grows.
+
+Run from the BackEnd directory:
+    python test_tools/bench_stacked_json.py
+'''
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'source'))
+from json_stream import StackedJSONDecoder
+
+regex_split_json_packets = re.compile('}\s*{')
+
+MESSAGE = {'msgid': 1000,
+           'handler': 'control',
+           'command': 'report_missing_item',
+           'data': {'line1': 'Alert! {}', 'line2': 'Missing item',
+                    'is_error': True, 'target': '10.10.40.3'}}
+
+
+def legacy_unpack(message, out):
+    '''
+    Former BaseConnectionHandler.unpack_json, reduced to the splitting logic.
+    '''
+    try:
+        out.append(json.loads(message))
+    except ValueError:
+        messages = regex_split_json_packets.split(message)
+        if len(messages) > 1:
+            messages[0] = messages[0].strip()[1:]
+            messages[-1] = messages[-1].strip()[:-1]
+            compiled_message = ''
+            for msg in messages:
+                compiled_message += '{' + msg + '}'
+                if compiled_message.count('"') % 2 == 0:
+                    legacy_unpack(compiled_message, out)
+                    compiled_message = ''
+
+
+def streaming_unpack(message, out):
+    out.extend(StackedJSONDecoder().feed(message))
+
+
+def measure(func, frame, repeat):
+    best = None
+    for _ in range(repeat):
+        out = []
+        start = time.time()
+        func(frame, out)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, len(out)
+
+
+def main():
+    encoded = json.dumps(MESSAGE)
+    print('%8s | %14s %9s | %14s %9s' % ('messages', 'legacy us/msg', 'decoded',
+                                        'stream us/msg', 'decoded'))
+    for count in [1, 10, 100, 1000, 10000]:
+        frame = ' '.join([encoded] * count)
+        repeat = max(1, 1000 // count)
+        legacy_time, legacy_count = measure(legacy_unpack, frame, repeat)
+        stream_time, stream_count = measure(streaming_unpack, frame, repeat)
+        print('%8d | %14.2f %9d | %14.2f %9d' %
+              (count, legacy_time * 1e6 / count, legacy_count,
+               stream_time * 1e6 / count, stream_count))
+
+
+if __name__ == '__main__':
+    main()
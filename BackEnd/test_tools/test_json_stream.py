@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''
+Tests for the stacked JSON decoder with split, truncated and over-closed
+frames. Every frame is decoded on its own, a bad document never costs the
+documents after it.
+
+Run from the BackEnd directory:
+    python test_tools/test_json_stream.py
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'source'))
+from json_stream import StackedJSONDecoder
+
+
+class StackedJSONDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.decoder = StackedJSONDecoder()
+
+    def feed(self, data):
+        return list(self.decoder.feed(data))
+
+    def test_stacked(self):
+        self.assertEqual(self.feed('{"a": 1} {"b": "}{"}\n{"c": [3]}'),
+                         [{'a': 1}, {'b': '}{'}, {'c': [3]}])
+
+    def test_split(self):
+        # Each half is malformed on its own, nothing is carried over
+        self.assertEqual(self.feed('{"a": 1}{"b":'), [{'a': 1}, None])
+        self.assertEqual(self.feed(' 2}{"c": 3}'), [None, {'c': 3}])
+        self.assertEqual(self.feed('{"d": 4}'), [{'d': 4}])
+
+    def test_truncated(self):
+        self.assertEqual(self.feed('{"msgid": 3, "handler": "control"'),
+                         [None])
+        self.assertEqual(self.feed('{"msgid": 4}'), [{'msgid': 4}])
+
+    def test_truncated_followed_by_document(self):
+        self.assertEqual(
+            self.feed('{"msgid": 3, "data": {"x": 1}{"msgid": 4}'),
+            [None, {'msgid': 4}])
+        self.assertEqual(self.feed('{"msgid": 5, "line": "a{b"{"msgid": 6}'),
+                         [None, {'msgid': 6}])
+
+    def test_over_closed(self):
+        self.assertEqual(self.feed('{"a": 1}}{"b":2}'),
+                         [{'a': 1}, None, {'b': 2}])
+        self.assertEqual(self.feed('{"a": 1}]]} {"b":2}'),
+                         [{'a': 1}, None, {'b': 2}])
+
+    def test_malformed_balanced(self):
+        self.assertEqual(self.feed('{"a": tru}{"b": 2}'), [None, {'b': 2}])
+        self.assertEqual(self.feed('garbage {"b": 2}'), [None, {'b': 2}])
+        self.assertEqual(self.feed('garbage'), [None])
+
+    def test_too_large(self):
+        decoder = StackedJSONDecoder(max_size=20)
+        self.assertEqual(
+            list(decoder.feed('{"a": 1}{"b": "%s"}{"c": 3}' % ('x' * 20))),
+            [{'a': 1}, None, {'c': 3}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+'''
+Tests for the MessagePack decoder with stacked and truncated frames. A
+message cut off at the end of a frame is reported as malformed, with the C
+extension of msgpack as well as with its pure Python fallback.
+
+Run from the BackEnd directory:
+    python test_tools/test_serialization.py
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'source'))
+import serialization
+
+msgpack = serialization.msgpack
+
+
+@unittest.skipIf(msgpack is None, 'msgpack is not installed')
+class MessagePackDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.decoder = serialization.MessagePackCodec().decoder(1000)
+        self.first = msgpack.packb({'msgid': 1}, use_bin_type=False)
+        self.second = msgpack.packb({'msgid': 2}, use_bin_type=False)
+
+    def feed(self, data):
+        return list(self.decoder.feed(data))
+
+    def test_stacked(self):
+        self.assertEqual(self.feed(self.first + self.second),
+                         [{'msgid': 1}, {'msgid': 2}])
+
+    def test_truncated(self):
+        self.assertEqual(self.feed(b'\x84\xa5msgid'), [None])
+        self.assertEqual(self.feed(self.first + self.second[:3]),
+                         [{'msgid': 1}, None])
+        # Nothing is carried over to the next frame
+        self.assertEqual(self.feed(self.second), [{'msgid': 2}])
+
+    def test_malformed(self):
+        self.assertEqual(self.feed(b'\xc1' + self.first), [None])
+
+    def test_too_large(self):
+        self.assertEqual(self.feed(b'\x00' * 2000), [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import logging
+from tornado import ioloop
+
+
+class AlertCoalescer:
+    '''
+    Merges repeated alerts. The first alert with a given target and content
+    is passed on right away and opens a window of window seconds. Identical
+    alerts within the window are only counted, and when the window ends one
+    alert carrying the count in 'repeat' is passed on, opening the next
+    window. A burst of identical alerts thus costs one alert per window, and
+    the window closes after a window without repeats.
+    '''
+    def __init__(self, forward, window, io_loop=None):
+        '''
+        Create the coalescer
+
+        :param forward: Function passing an alert on, called on the IOLoop
+        :param window: Seconds during which identical alerts are merged, 0
+         to pass every alert on
+        :param io_loop: IOLoop, the global instance if None
+        :return: None
+        '''
+        self.forward = forward
+        self.window = window
+        self.io_loop = io_loop
+        # Open windows per alert key, as [repeats, last alert]
+        self.windows = {}
+        # Counters
+        self.coalesced = 0
+
+    def get_io_loop(self):
+        return self.io_loop or ioloop.IOLoop.instance()
+
+    def put(self, alert):
+        '''
+        Add an alert. Safe to call from any thread.
+
+        :param alert: Alert, a dict
+        :return: None
+        '''
+        self.get_io_loop().add_callback(self.add, alert)
+
+    def add(self, alert):
+        if not self.window:
+            self.forward(alert)
+            return
+        key = json.dumps(alert, sort_keys=True)
+        entry = self.windows.get(key)
+        if entry is not None:
+            entry[0] += 1
+            entry[1] = alert
+            self.coalesced += 1
+            return
+        self.windows[key] = [0, alert]
+        self.forward(alert)
+        self.get_io_loop().call_later(self.window, self.close_window, key)
+
+    def close_window(self, key):
+        '''
+        Pass on the repeats counted in a window, and keep the window open
+        for more repeats. Close it if there were none.
+
+        :param key: Alert key
+        :return: None
+        '''
+        repeats, alert = self.windows[key]
+        if repeats == 0:
+            del self.windows[key]
+            return
+        logging.info('Coalesced %d repeats of alert %s' % (repeats, key))
+        alert = dict(alert)
+        alert['repeat'] = repeats
+        self.windows[key] = [0, alert]
+        self.forward(alert)
+        self.get_io_loop().call_later(self.window, self.close_window, key)
@@ -0,0 +1,150 @@
+import time
+import tornado.escape
+from tornado.websocket import WebSocketProtocol13, WebSocketClientConnection
+
+
+def compression_options(config):
+    '''
+    Get the permessage-deflate options from the [compression] section.
+
+    :param config: Configuration
+    :return: Options for tornado, or None if compression is disabled
+    '''
+    if not config.getboolean('compression', 'enabled'):
+        return None
+    return {'compression_level': config.getint('compression', 'level'),
+            'mem_level': config.getint('compression', 'mem_level')}
+
+
+class CompressionStats:
+    '''
+    Counters of the compression done on one channel.
+    '''
+    def __init__(self):
+        self.messages_out = 0
+        self.compressed_out = 0
+        # Payload bytes before and after compression
+        self.bytes_out = 0
+        self.wire_bytes_out = 0
+        self.compress_seconds = 0.0
+        self.compressed_in = 0
+        self.bytes_in = 0
+        self.wire_bytes_in = 0
+        self.decompress_seconds = 0.0
+
+    def as_dict(self):
+        '''
+        Get the counters, with the compression ratio (bytes before / after
+        compression) and the CPU time spent per compressed message.
+
+        :return: Dict with the counters
+        '''
+        return {'messages_out': self.messages_out,
+                'compressed_out': self.compressed_out,
+                'bytes_out': self.bytes_out,
+                'wire_bytes_out': self.wire_bytes_out,
+                'ratio_out': ratio(self.bytes_out, self.wire_bytes_out),
+                'compress_us': per_message_us(self.compress_seconds,
+                                              self.compressed_out),
+                'compressed_in': self.compressed_in,
+                'ratio_in': ratio(self.bytes_in, self.wire_bytes_in),
+                'decompress_us': per_message_us(self.decompress_seconds,
+                                                self.compressed_in)}
+
+
+def ratio(raw, compressed):
+    if compressed == 0:
+        return 1.0
+    return round(float(raw) / compressed, 2)
+
+
+def per_message_us(seconds, messages):
+    if messages == 0:
+        return 0.0
+    return round(seconds * 1e6 / messages, 1)
+
+
+class TimedDecompressor:
+    '''
+    Wraps the permessage-deflate decompressor of a connection to count the
+    decompressed bytes and the time spent.
+    '''
+    def __init__(self, decompressor, stats):
+        self.decompressor = decompressor
+        self.stats = stats
+
+    def decompress(self, data):
+        start = time.time()
+        decompressed = self.decompressor.decompress(data)
+        self.stats.decompress_seconds += time.time() - start
+        self.stats.compressed_in += 1
+        self.stats.wire_bytes_in += len(data)
+        self.stats.bytes_in += len(decompressed)
+        return decompressed
+
+
+class ThresholdWebSocketProtocol(WebSocketProtocol13):
+    '''
+    Websocket protocol that only compresses messages of at least min_size
+    bytes, when permessage-deflate was negotiated. Compressing small messages
+    costs more CPU than it saves on the network. Each message carries its own
+    compressed flag, so peers handle the mix without any change.
+    '''
+    def __init__(self, handler, mask_outgoing=False, compression_options=None,
+                 min_size=0, stats=None):
+        WebSocketProtocol13.__init__(self, handler,
+                                     mask_outgoing=mask_outgoing,
+                                     compression_options=compression_options)
+        self.min_size = min_size
+        if stats is None:
+            stats = CompressionStats()
+        self.stats = stats
+
+    def _create_compressors(self, side, agreed_parameters,
+                            compression_options=None):
+        WebSocketProtocol13._create_compressors(self, side, agreed_parameters,
+                                                compression_options)
+        self._decompressor = TimedDecompressor(self._decompressor, self.stats)
+
+    def write_message(self, message, binary=False):
+        '''
+        Send a message. Follows WebSocketProtocol13.write_message, with the
+        size threshold and counters added.
+        '''
+        if binary:
+            opcode = 0x2
+        else:
+            opcode = 0x1
+        message = tornado.escape.utf8(message)
+        self._message_bytes_out += len(message)
+        self.stats.messages_out += 1
+        self.stats.bytes_out += len(message)
+        flags = 0
+        if self._compressor and len(message) >= self.min_size:
+            start = time.time()
+            message = self._compressor.compress(message)
+            self.stats.compress_seconds += time.time() - start
+            self.stats.compressed_out += 1
+            flags |= self.RSV1
+        self.stats.wire_bytes_out += len(message)
+        return self._write_frame(True, opcode, message, flags=flags)
+
+
+class ThresholdWebSocketClientConnection(WebSocketClientConnection):
+    '''
+    Client side websocket connection using ThresholdWebSocketProtocol. The
+    counters are available as stats.
+    '''
+    def __init__(self, io_loop, request, compression_options=None, min_size=0,
+                 **kwargs):
+        self.min_size = min_size
+        self.stats = CompressionStats()
+        WebSocketClientConnection.__init__(
+            self, io_loop, request, compression_options=compression_options,
+            **kwargs)
+
+    def get_websocket_protocol(self):
+        return ThresholdWebSocketProtocol(
+            self, mask_outgoing=True,
+            compression_options=self.compression_options,
+            min_size=self.min_size, stats=self.stats)
@@ -0,0 +1,55 @@
+import collections
+import itertools
+
+# Message ids count up from 1000 and do not wrap within the 64-bit range
+# MessagePack and the JSON parsers of the clients handle, so an id is never
+# reused while a message with the same id may still be in flight.
+FIRST_ID = 1000
+MAX_ID = 2 ** 63 - 1
+message_ids = itertools.count(FIRST_ID)
+
+
+def next_id():
+    '''
+    Generate a message id, unique within this process.
+
+    :return: Id
+    '''
+    msgid = next(message_ids)
+    if msgid > MAX_ID:
+        raise OverflowError('Message id space exhausted')
+    return msgid
+
+
+class DuplicateFilter:
+    '''
+    Remembers the ids of the last size messages received on a connection, to
+    drop retransmitted messages that were handled already.
+    '''
+    def __init__(self, size=1024):
+        self.size = size
+        self.reset()
+
+    def seen(self, msgid):
+        '''
+        Check a received message id, and remember it.
+
+        :param msgid: Message id
+        :return: True if the id was received before
+        '''
+        if msgid in self.ids:
+            return True
+        if len(self.order) >= self.size:
+            self.ids.discard(self.order.popleft())
+        self.order.append(msgid)
+        self.ids.add(msgid)
+        return False
+
+    def reset(self):
+        '''
+        Forget all ids, for a new connection.
+
+        :return: None
+        '''
+        self.ids = set()
+        self.order = collections.deque()
@@ -3,62 +3,124 @@ from tornado import gen
 from tornado import httpclient
 from tornado import httputil
 from tornado import ioloop
-from tornado import websocket
 
-from Queue import Queue, Empty
 from config_handler import config, prefs
-from multiprocessing.pool import ThreadPool
+from message_log import MessageLogger
 
 import client as client_module
+import coalesce
+import compression
+import delivery
+import heartbeat
+import outbox as outbox_module
+import reconnect
+import serialization
 import pyupm_i2clcd as lcd
 import functools
 import json
-import time
 import logging
-import re
-import pprint
-import datetime
 
 
 DEFAULT_CONNECT_TIMEOUT = 60
 DEFAULT_REQUEST_TIMEOUT = 60
 
-regex_split_json_packets = re.compile('}\s*{')
-message_queue = Queue()
+# Notifications waiting to be sent to the backend, see enqueue_message
+outbox = outbox_module.create_outbox(config)
+# Repeated alerts are merged before they reach the outbox
+alerts = coalesce.AlertCoalescer(outbox.append,
+                                 config.getfloat('outbox', 'coalesce_window'))
+message_log = MessageLogger(
+    sample_every=config.getint('server', 'message_log_sample'))
 iot_connected = False
 
 devices = []
 
+
+class HeartbeatClientConnection(
+        compression.ThresholdWebSocketClientConnection):
+    '''
+    Client connection that measures the round trip time of its keep-alive
+    pings in rtt.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.rtt = heartbeat.RoundTripTime()
+        compression.ThresholdWebSocketClientConnection.__init__(self, *args,
+                                                                **kwargs)
+
+    def on_pong(self, data):
+        self.rtt.observe_pong(self.protocol)
+
+
 class WebSocketClient():
     """
     Base for web socket clients.
     """
 
     def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
-                 request_timeout=DEFAULT_REQUEST_TIMEOUT):
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT, codec='json',
+                 compression_options=None, compression_min_size=0,
+                 ping_interval=0, ping_timeout=None, reconnect_delay=2,
+                 reconnect_max_delay=60, reconnect_jitter=0.5,
+                 reconnect_stable=30):
         logging.info('Initializing WebSocketClient instance')
         self.connect_timeout = connect_timeout
         self.request_timeout = request_timeout
         self.devices = []
+        # Codec requested from the server and codec actually in use. JSON is
+        # used until the server selects the requested codec.
+        self.requested_codec = (serialization.get_codec(codec) or
+                                serialization.default_codec)
+        self.codec = serialization.default_codec
+        self.decoder = self.codec.decoder()
+        # permessage-deflate options, None to not request compression
+        self.compression_options = compression_options
+        self.compression_min_size = compression_min_size
+        self.compression_stats = None
+        # Seconds between keep-alive pings, 0 for none, and seconds without
+        # pong before the connection is closed
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.rtt = None
+        # Reconnects wait on the IOLoop, see schedule_reconnect
+        self.url = None
+        self.backoff = reconnect.Backoff(reconnect_delay, reconnect_max_delay,
+                                         reconnect_jitter)
+        self.connection_stats = reconnect.ConnectionStats()
+        self.reconnect_timeout = None
+        # The backoff starts over once a connection stayed up for
+        # reconnect_stable seconds, a backend that accepts and closes right
+        # away does not reset it
+        self.reconnect_stable = reconnect_stable
+        self.stable_timeout = None
 
     def connect(self, io_loop=None, url=None):
         """
         Connect to the server.
 
-        :param str url: server URL.
+        :param str url: server URL. If None, the URL of the last connect.
         """
         if url is None:
-            url = 'ws://localhost:8878/API-ws/'
+            url = self.url or 'ws://localhost:8878/API-ws/'
+        self.url = url
+        self.connection_stats.attempt()
         if io_loop is None:
             io_loop = ioloop.IOLoop.current()
 
         logging.info('Opening websocket to IoT-Backend: %s' % str(url))
         headers = httputil.HTTPHeaders({'Content-Type': 'application/json'})
+        if self.requested_codec is not serialization.default_codec:
+            headers['Sec-WebSocket-Protocol'] = serialization.subprotocol_for(
+                self.requested_codec)
         request = httpclient.HTTPRequest(url=url,
                                          connect_timeout=self.connect_timeout,
                                          request_timeout=self.request_timeout,
                                          headers=headers)
-        ws_conn = websocket.WebSocketClientConnection(io_loop, request)
+        ws_conn = HeartbeatClientConnection(
+            io_loop, request, compression_options=self.compression_options,
+            min_size=self.compression_min_size,
+            ping_interval=self.ping_interval, ping_timeout=self.ping_timeout)
+        self.compression_stats = ws_conn.stats
+        self.rtt = ws_conn.rtt
         ws_conn.connect_future.add_done_callback(self.connect_callback)
 
     def send(self, data):
@@ -90,11 +152,46 @@ class WebSocketClient():
         '''
         if future.exception() is None:
             self.ws_connection = future.result()
+            selected = self.ws_connection.headers.get('Sec-WebSocket-Protocol')
+            self.codec = (serialization.codec_for_subprotocol(selected) or
+                          serialization.default_codec)
+            self.decoder = self.codec.decoder()
+            outage = self.connection_stats.connected()
+            self.stable_timeout = ioloop.IOLoop.current().call_later(
+                self.reconnect_stable, self.on_connection_stable)
+            if outage is not None:
+                logging.info('Connected after an outage of %.1f s: %s' %
+                             (outage, self.connection_stats.as_dict()))
             self.on_connection_success()
             self.read_messages()
         else:
+            self.connection_stats.failed()
             self.on_connection_error(future.exception())
 
+    def schedule_reconnect(self):
+        '''
+        Connect again after the next backoff delay. The delay is a timeout
+        on the IOLoop, so sensing and the display keep running during an
+        outage.
+
+        :return: None
+        '''
+        if self.reconnect_timeout is not None:
+            # Already scheduled
+            return
+        delay = self.backoff.next_delay()
+        logging.info('Reconnecting in %.1f s' % delay)
+        self.reconnect_timeout = ioloop.IOLoop.current().call_later(
+            delay, self.reconnect)
+
+    def reconnect(self):
+        self.reconnect_timeout = None
+        self.connect()
+
+    def on_connection_stable(self):
+        self.stable_timeout = None
+        self.backoff.reset()
+
     @gen.coroutine
     def read_messages(self):
         '''
@@ -105,6 +202,11 @@ class WebSocketClient():
         while True:
             msg = yield self.ws_connection.read_message()
             if msg is None:
+                if self.stable_timeout is not None:
+                    ioloop.IOLoop.current().remove_timeout(
+                        self.stable_timeout)
+                    self.stable_timeout = None
+                self.connection_stats.disconnected()
                 self.on_connection_close()
                 break
 
@@ -145,7 +247,6 @@ class IoTWebSocketClient(WebSocketClient):
     Create a communication channel to the IoT Backend
     and handle all incoming/outgoing communication to it.
     '''
-    prev_id = 1000
 
     def on_connection_success(self):
         """
@@ -160,63 +261,61 @@ class IoTWebSocketClient(WebSocketClient):
             self.thisLCD = lcd.Jhd1313m1(0, 0x3E, 0x62)
         iot_connected = True
         logging.info('IoT Connected! Conn:%s' % str(iot_connected))
+        # Ids of the messages received on this connection, to drop the ones
+        # the backend retransmits
+        self.duplicates = delivery.DuplicateFilter()
         self.send_message('channel', 'setchannelmode',
                           {'channelmode': 'control',
-                           'clientname': 'SB' + str(randint(0,100))})
-        pool_tx = ThreadPool(processes=1)
-        async_tx = pool_tx.apply_async(self.inspect_queue_for_messages, ())
+                           'clientname': 'SB' + str(randint(0,100)),
+                           'reliable': True})
+        outbox.attach(self.send_notifications)
 
     def on_connection_close(self):
         """
         This is called when server closed the connection. After server closes
-        connection, This will try to reconnect immediately to reestablish
+        connection, a reconnect is scheduled with backoff to reestablish
         communication.
         """
         global iot_connected
         iot_connected = False
         self.ws_connection = None
+        outbox.detach()
         logging.info('IoT Connection closed! Conn:%s' % str(iot_connected))
-        time.sleep(prefs.getint('timeouts', 'timeout_iot_retry', fallback=2))
-        self.connect()
+        logging.info('Outbox: %s' % outbox.as_dict())
+        if self.compression_stats is not None:
+            logging.info('Compression of connection: %s' %
+                         self.compression_stats.as_dict())
+        if self.rtt is not None:
+            logging.info('Round trip time of connection: %s' %
+                         self.rtt.as_dict())
+        self.schedule_reconnect()
 
     def on_connection_error(self, exception):
         """
         This is called in case if connection to the server could
-        not be established. This will try to reconnect immediately to
+        not be established. A reconnect is scheduled with backoff to
         establish communication. Connection error might occur when clients
         try to connect when server is down.
         """
         global iot_connected
         iot_connected = False
         self.ws_connection = None
+        outbox.detach()
         logging.warning('IoT Connection error: Conn %s | %s' %
                         (str(iot_connected), str(exception)))
-        time.sleep(prefs.getint('timeouts', 'timeout_nms_retry', fallback=2))
-        self.connect()
+        self.schedule_reconnect()
 
-    def inspect_queue_for_messages(self):
+    def send_notifications(self, messages):
         '''
-        Asynchronously run to constantly inspect if there is any existing
-        message in the queue to be sent to the IoT. Any other
-        module wanting to send a notification should place it first in the
-        queue.
+        Send notifications from the outbox to the IoT, stacked in one frame.
+        Any other module wanting to send a notification should place it in
+        the outbox with enqueue_message. The outbox keeps them until the IoT
+        acknowledges their msgids, see process_message.
 
-        :return: None
+        :param messages: List of notifications
+        :return: List of msgids, None if not connected
         '''
-        import random
-        while True:
-            try:
-                if iot_connected:
-                    tx_message = message_queue.get(block=True, timeout=5)
-                    if tx_message:
-                        self.send_message('control', 'report_missing_item',
-                                          tx_message)
-                    else:
-                        raise Empty
-            except Empty:
-                # TODO remove autogenerating notifications. Just for testing
-                continue
-        return
+        return self.send_stacked('control', 'report_missing_item', messages)
 
     def send_message(self, handler, msgtype, msg, respond_id=None):
         '''
@@ -238,38 +337,59 @@ class IoTWebSocketClient(WebSocketClient):
             'data': msg
         }
 
-        logging.info(
-            '%s | Sending to %s - msgid: %s, handler: %s, command: %s' %
-            (str(datetime.datetime.now()),
-             'IoT', respond_id, handler, msgtype))
-        pp_message = pprint.pformat(message)
-        logging.info(
-            '>>>Sending to IoT Backend<<<\n' +
-            '\treceiver:\t\t%s\n' % 'IoT Backend' +
-            '\thandler:\t%s\n\tmessage id:\t%d\n' % (handler, respond_id) +
-            '\tmessagetype:\t%s\n' % (msgtype) +
-            '\t=============================================\n'
-            '\t%s\n' % str(pp_message) +
-            '\t=============================================')
+        message_log.sent('IoT', None, handler, respond_id, msgtype, message)
 
         if not self.ws_connection:
             logging.warning('Web socket connection is closed.')
             return
-        self.ws_connection.write_message(escape.utf8(json.dumps(message)))
+        self.ws_connection.write_message(self.codec.encode(message),
+                                         binary=self.codec.binary)
+
+    def send_stacked(self, handler, msgtype, msgs):
+        '''
+        Send several messages of the same type stacked in one frame. The
+        backend handles them in order, as if sent one by one.
+
+        :param handler: API handler the messages are for
+        :param msgtype: Type of the messages
+        :param msgs: List of payloads
+        :return: List of the msgids of the messages, None if not connected
+        '''
+        if not self.ws_connection:
+            logging.warning('Web socket connection is closed.')
+            return None
+        frames = []
+        msgids = []
+        for msg in msgs:
+            msgid = self.generate_id()
+            msgids.append(msgid)
+            message = {'msgid': msgid, 'handler': handler,
+                       'command': msgtype, 'data': msg}
+            message_log.sent('IoT', None, handler, msgid, msgtype, message)
+            frames.append(self.codec.encode(message))
+        self.ws_connection.write_message(b''.join(frames),
+                                         binary=self.codec.binary)
+        return msgids
 
     def on_message(self, message):
         '''
-        Handle an incoming message on the websocket.
+        Handle an incoming message on the websocket. A frame may hold several
+        messages stacked together, each of them is handled in order.
 
         :param message: JSON Message as received from websocket
         :return: None
         '''
-        try:
-            message = self.unpack_json(message)
-            if message is None:
-                # Either malformed JSON or stacked and handled separately
-                return
+        for unpacked_json in self.unpack_json(message):
+            self.handle_message(unpacked_json)
+
+    def handle_message(self, message):
+        '''
+        Handle a single unpacked message.
 
+        :param message: Unpacked JSON in a Python dictionary
+        :return: None
+        '''
+        try:
             unpacked = self.unpack_message(message)
             if unpacked is None:
                 # Invalid data in message, already handled
@@ -289,40 +409,19 @@ class IoTWebSocketClient(WebSocketClient):
 
     def unpack_json(self, message):
         '''
-        Try to unpack the message into a Python dict. If it fails, first check
-        whether this is because several packets are stacked together.
+        Unpack the frame into Python dictionaries. Several packets may be
+        stacked together in one frame and a packet may continue in the next
+        frame, so the frame is fed to the streaming decoder of the codec.
 
-        :param message: JSON Message as received from websocket
-        :return: Unpacked JSON in a Python dictionary
+        :param message: Frame as received from websocket
+        :return: Generator of unpacked JSON in Python dictionaries
         '''
-        try:
-            message = json.loads(message)
-            return message
-        except ValueError:
-            # Try if stacked request
-            messages = regex_split_json_packets.split(message)
-            if len(messages) > 1:
-                # Remove trailing '{' and '}' from resp. first and last elem
-                messages[0] = messages[0].strip()[1:]
-                messages[-1] = messages[-1].strip()[:-1]
-
-                compiled_message = ''
-                for msg in messages:
-                    # Reconstruct message after previous split
-
-                    compiled_message += '{' + msg + '}'
-
-                    # Check if count of " characters is equal. If not, it is
-                    # part of a data field and the message should not be split
-                    # here.
-                    if compiled_message.count('"') % 2 == 0:
-                        # Split message complete, call with separate
-                        self.on_message(compiled_message)
-                        compiled_message = ''
-                return
-
-            logging.warning('Malformed JSON packet received from IoT')
-            return
+        for unpacked_json in self.decoder.feed(message):
+            if unpacked_json is None:
+                logging.warning('Malformed %s packet received from IoT' %
+                                self.codec.name)
+                continue
+            yield unpacked_json
 
     def unpack_message(self, message):
         '''
@@ -366,18 +465,25 @@ class IoTWebSocketClient(WebSocketClient):
         :param message: Full message in Python dictionary
         :return: None
         '''
-        logging.info(
-            '%s | Receiving from IoT - msgid: %d, handler: %s, command: %s' %
-            (str(datetime.datetime.now()), msgid, handler, msgtype))
-        pp_data = pprint.pformat(data)
-        logging.info(
-            '>>>Receiving from IoT<<<\n' +
-            '\tsender:\t\t%s\n' % 'IoT' +
-            '\thandler:\t%s\n\tmessage id:\t%d\n' % (handler, msgid) +
-            '\tmessagetype:\t%s\n' % (msgtype) +
-            '\t=============================================\n'
-            '\t%s\n' % str(pp_data) +
-            '\t=============================================')
+        message_log.received('IoT', None, handler, msgid, msgtype, data)
+
+        if msgtype == 'ack':
+            outbox.acknowledge(msgid)
+        elif msgtype == 'error':
+            if isinstance(data, dict) and 'retry_after' in data:
+                # Dropped by the inbound rate limit of the backend
+                outbox.throttled(msgid, data['retry_after'])
+            else:
+                # Answered, sending it again would fail again
+                outbox.acknowledge(msgid)
+        else:
+            # Acknowledge every message that is not a response, the backend
+            # retransmits it until acknowledged. A retransmission of a
+            # message that was handled already is dropped
+            self.send_message(handler, 'ack', None, msgid)
+            if self.duplicates.seen(msgid):
+                logging.info('Dropping duplicate message %d from IoT' % msgid)
+                return
 
         response = None
         try:
@@ -466,6 +572,8 @@ class IoTWebSocketClient(WebSocketClient):
         line1 = message['line1']
         line2 = message['line2']
         is_error = message['is_error']
+        if message.get('repeat'):
+            line2 = '%s x%d' % (line2, message['repeat'] + 1)
 
         print(line1)
         print(line2)
@@ -552,14 +660,16 @@ class IoTWebSocketClient(WebSocketClient):
         return ('control', receivers, 'notification', data, None)
 
     def generate_id(self):
-        '''Generate a message ID to use. Yield sequence from 1000-9999'''
-        self.prev_id = ((self.prev_id - 999) % 9000) + 1000
-        return self.prev_id
+        '''Generate a message ID to use, see delivery.next_id'''
+        return delivery.next_id()
 
 
 def enqueue_message(message, check_connected=False):
     '''
-    Add a new notification to the outgoing messages queue to be sent to IoT.
+    Add a new notification to the outbox to be sent to IoT. Safe to call
+    from any thread, the message is sent from the IOLoop. Repeats of the same
+    notification within the coalesce window are sent as one, with their
+    number in 'repeat'.
 
     :param message: Message to be sent. It is a dictionary with the
      corresponding key, value pairs.
@@ -578,7 +688,7 @@ def enqueue_message(message, check_connected=False):
                      + str(message))
     except Exception:
         pass
-    message_queue.put(message)
+    alerts.put(message)
     return
 
 # def main():
@@ -0,0 +1,131 @@
+import json
+import re
+
+# Whitespace allowed between stacked JSON documents
+regex_whitespace = re.compile(r'\s*')
+# Characters that matter when looking for the end of a JSON document
+regex_structural = re.compile(r'["\\{}\[\]]')
+# Where a JSON document may start
+regex_document_start = re.compile(r'[{\[]')
+# Characters after which a '{' is a value inside the current document
+VALUE_FOLLOWS = ':,[{'
+
+
+class StackedJSONDecoder:
+    '''
+    Decoder for frames that hold several JSON documents stacked one after the
+    other, e.g. '{"msgid": 1, ...}{"msgid": 2, ...}'.
+
+    The frame is walked once: every document is decoded in place with
+    raw_decode and the position advances past it. A websocket frame is
+    always a whole message, so nothing is kept between frames and a
+    document still incomplete at the end of a frame is malformed. After a
+    malformed document decoding resumes at the next document in the frame.
+    '''
+    def __init__(self, max_size=None):
+        '''
+        :param max_size: Maximum length of one document, None for no
+         limit
+        '''
+        self.decoder = json.JSONDecoder()
+        self.max_size = max_size
+
+    def feed(self, data):
+        '''
+        Decode all documents in a frame.
+
+        Yields every decoded document in order. A malformed, incomplete or
+        too large document yields None, so the caller can report it.
+
+        :param data: Received frame
+        :return: Generator of decoded documents
+        '''
+        pos = regex_whitespace.match(data, 0).end()
+        end_of_data = len(data)
+        while pos < end_of_data:
+            try:
+                if data[pos] not in '{[':
+                    # Messages are objects, a bare value is left over from
+                    # something malformed
+                    raise ValueError('No JSON document')
+                start = pos
+                message, pos = self.decoder.raw_decode(data, pos)
+                if self.max_size is not None and \
+                        pos - start > self.max_size:
+                    message = None
+            except ValueError:
+                pos = self.find_next_document(data, pos)
+                message = None
+            yield message
+            pos = regex_whitespace.match(data, pos).end()
+
+    def find_next_document(self, data, pos):
+        '''
+        Find where decoding resumes after the malformed document starting at
+        pos. That is the end of the document if its brackets are balanced, or
+        a '{' that cannot be a value inside it, as when a truncated document
+        is followed by the next one. Nesting depth is tracked outside of
+        strings and only structural characters are visited.
+
+        :param data: Frame
+        :param pos: Start of the malformed document
+        :return: Index to resume at, len(data) if there is no next document
+        '''
+        if data[pos] not in '{[':
+            # Not an object or array, e.g. a stray '}', skip to the next one
+            match = regex_document_start.search(data, pos + 1)
+            if match is None:
+                return len(data)
+            return match.start()
+
+        depth = 0
+        in_string = False
+        match = regex_structural.search(data, pos)
+        while match is not None:
+            char = match.group()
+            index = match.end()
+            if in_string:
+                if char == '\\':
+                    # Skip the escaped character
+                    index += 1
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in '{[':
+                if depth > 0 and char == '{' and \
+                        self.previous_char(data, match.start()) \
+                        not in VALUE_FOLLOWS:
+                    # A new document, the current one was cut off
+                    return match.start()
+                depth += 1
+            elif char in '}]':
+                depth -= 1
+                if depth == 0:
+                    return index
+            match = regex_structural.search(data, index)
+        return len(data)
+
+    def previous_char(self, data, index):
+        '''
+        Get the last character before index that is not whitespace.
+
+        :param data: Frame
+        :param index: Index
+        :return: Character, or '' at the start of the frame
+        '''
+        index -= 1
+        while index >= 0 and data[index] in ' \t\r\n':
+            index -= 1
+        if index < 0:
+            return ''
+        return data[index]
+
+    def reset(self):
+        '''
+        Nothing is buffered between frames, kept for the interface shared
+        with the other decoders.
+
+        :return: None
+        '''
+        pass
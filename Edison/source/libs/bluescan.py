@@ -2,14 +2,22 @@
 # performs a simple device inquiry, followed by a remote name request of each
 # discovered device
 
+import errno
 import os
 import sys
 import struct
 import bluetooth._bluetooth as bluez
 import bluetooth
+from tornado import gen
+from tornado import ioloop
+from tornado.concurrent import Future
 
 
 SIGNAL_THRESHOLD = -50
+# Inquiry length in units of 1.28 s
+INQUIRY_DURATION = 5
+# HCI socket with the inquiry mode set up, shared by the asynchronous scans
+scanner_sock = None
 
 def printpacket(pkt):
     for c in pkt:
@@ -73,6 +81,42 @@ def write_inquiry_mode(sock, mode):
     if status != 0: return -1
     return 0
 
+def send_inquiry(sock, duration, max_responses=255):
+    cmd_pkt = struct.pack("BBBBB", 0x33, 0x8b, 0x9e, duration, max_responses)
+    bluez.hci_send_cmd(sock, bluez.OGF_LINK_CTL, bluez.OCF_INQUIRY, cmd_pkt)
+
+def parse_inquiry_event(pkt, results):
+    """adds the devices of an inquiry event to results as (addr, rssi),
+    returns True when the inquiry is over"""
+    ptype, event, plen = struct.unpack("BBB", pkt[:3])
+    if event == bluez.EVT_INQUIRY_RESULT_WITH_RSSI:
+        pkt = pkt[3:]
+        nrsp = bluetooth.get_byte(pkt[0])
+        for i in range(nrsp):
+            addr = bluez.ba2str( pkt[1+6*i:1+6*i+6] )
+            rssi = bluetooth.byte_to_signed_int(
+                    bluetooth.get_byte(pkt[1+13*nrsp+i]))
+            results.append( ( addr, rssi ) )
+            #print("[%s] RSSI: [%d]" % (addr, rssi))
+    elif event == bluez.EVT_INQUIRY_COMPLETE:
+        return True
+    elif event == bluez.EVT_CMD_STATUS:
+        status, ncmd, opcode = struct.unpack("BBH", pkt[3:7])
+        if status != 0:
+            print("uh oh...")
+            printpacket(pkt[3:7])
+            return True
+    elif event == bluez.EVT_INQUIRY_RESULT:
+        pkt = pkt[3:]
+        nrsp = bluetooth.get_byte(pkt[0])
+        for i in range(nrsp):
+            addr = bluez.ba2str( pkt[1+6*i:1+6*i+6] )
+            results.append( ( addr, -1 ) )
+            print("[%s] (no RRSI)" % addr)
+    else:
+        print("unrecognized packet type 0x%02x" % ptype)
+    return False
+
 def device_inquiry_with_with_rssi(sock):
     # save current filter
     old_filter = sock.getsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, 14)
@@ -86,44 +130,14 @@ def device_inquiry_with_with_rssi(sock):
     bluez.hci_filter_set_ptype(flt, bluez.HCI_EVENT_PKT)
     sock.setsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, flt )
 
-    duration = 5
-    max_responses = 255
-    cmd_pkt = struct.pack("BBBBB", 0x33, 0x8b, 0x9e, duration, max_responses)
-    bluez.hci_send_cmd(sock, bluez.OGF_LINK_CTL, bluez.OCF_INQUIRY, cmd_pkt)
+    send_inquiry(sock, INQUIRY_DURATION)
 
     results = []
 
     done = False
     while not done:
         pkt = sock.recv(255)
-        ptype, event, plen = struct.unpack("BBB", pkt[:3])
-        if event == bluez.EVT_INQUIRY_RESULT_WITH_RSSI:
-            pkt = pkt[3:]
-            nrsp = bluetooth.get_byte(pkt[0])
-            for i in range(nrsp):
-                addr = bluez.ba2str( pkt[1+6*i:1+6*i+6] )
-                rssi = bluetooth.byte_to_signed_int(
-                        bluetooth.get_byte(pkt[1+13*nrsp+i]))
-                results.append( ( addr, rssi ) )
-                #print("[%s] RSSI: [%d]" % (addr, rssi))
-        elif event == bluez.EVT_INQUIRY_COMPLETE:
-            done = True
-        elif event == bluez.EVT_CMD_STATUS:
-            status, ncmd, opcode = struct.unpack("BBH", pkt[3:7])
-            if status != 0:
-                print("uh oh...")
-                printpacket(pkt[3:7])
-                done = True
-        elif event == bluez.EVT_INQUIRY_RESULT:
-            pkt = pkt[3:]
-            nrsp = bluetooth.get_byte(pkt[0])
-            for i in range(nrsp):
-                addr = bluez.ba2str( pkt[1+6*i:1+6*i+6] )
-                results.append( ( addr, -1 ) )
-                print("[%s] (no RRSI)" % addr)
-        else:
-            print("unrecognized packet type 0x%02x" % ptype)
-        #print("event ", event)
+        done = parse_inquiry_event(pkt, results)
 
 
     # restore old filter
@@ -161,11 +175,15 @@ def check_devices(devices):
             print("error while setting inquiry mode")
         print("result: %d" % result)
 
-    missing = []
     results = device_inquiry_with_with_rssi(sock)
     for a in results:
         print a
 
+    return find_missing(devices, results)
+
+def find_missing(devices, results):
+    """returns the names of the devices not found close enough"""
+    missing = []
     for device in devices:
         key = device['mac']
         found = 0
@@ -178,6 +196,102 @@ def check_devices(devices):
 
     return missing
 
+class AsyncInquiry(object):
+    """Device inquiry that runs on the IOLoop. Instead of blocking in recv
+    for the whole inquiry, the HCI socket is watched by the IOLoop and every
+    event is parsed as it arrives. start() returns a Future resolved with
+    the list of (addr, rssi) once the inquiry is complete."""
+
+    def __init__(self, sock, io_loop=None, duration=INQUIRY_DURATION):
+        self.sock = sock
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.duration = duration
+        self.results = []
+        self.future = Future()
+        self.old_filter = None
+        self.timeout = None
+
+    def start(self):
+        # save current filter, and receive all events like
+        # device_inquiry_with_with_rssi
+        self.old_filter = self.sock.getsockopt( bluez.SOL_HCI,
+                bluez.HCI_FILTER, 14)
+        flt = bluez.hci_filter_new()
+        bluez.hci_filter_all_events(flt)
+        bluez.hci_filter_set_ptype(flt, bluez.HCI_EVENT_PKT)
+        self.sock.setsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, flt )
+
+        self.sock.setblocking(False)
+        self.io_loop.add_handler(self.sock.fileno(), self.on_readable,
+                ioloop.IOLoop.READ)
+        # The controller ends the inquiry after duration * 1.28 s, do not
+        # wait forever if it never reports that
+        self.timeout = self.io_loop.call_later(self.duration * 1.28 + 5,
+                self.finish, IOError("inquiry timed out"))
+        try:
+            send_inquiry(self.sock, self.duration)
+        except Exception as e:
+            self.finish(e)
+        return self.future
+
+    def on_readable(self, fd, events):
+        while not self.future.done():
+            try:
+                pkt = self.sock.recv(255)
+            except (bluez.error, IOError, OSError) as e:
+                if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # All events so far parsed, wait for more
+                    return
+                self.finish(e)
+                return
+            if parse_inquiry_event(pkt, self.results):
+                self.finish()
+
+    def finish(self, exception=None):
+        if self.future.done():
+            return
+        self.io_loop.remove_handler(self.sock.fileno())
+        self.io_loop.remove_timeout(self.timeout)
+        try:
+            # restore old filter
+            self.sock.setblocking(True)
+            self.sock.setsockopt( bluez.SOL_HCI, bluez.HCI_FILTER,
+                    self.old_filter )
+        except Exception as e:
+            print("error restoring the HCI socket: %s" % e)
+        if exception is not None:
+            self.future.set_exception(exception)
+        else:
+            self.future.set_result(self.results)
+
+def get_scanner_sock(dev_id=0):
+    """returns the HCI socket of the device, opened and switched to inquiry
+    mode 1 (results with RSSI) on first use"""
+    global scanner_sock
+    if scanner_sock is None:
+        sock = bluez.hci_open_dev(dev_id)
+        if read_inquiry_mode(sock) != 1 and write_inquiry_mode(sock, 1) != 0:
+            sock.close()
+            raise IOError("error while setting inquiry mode")
+        scanner_sock = sock
+    return scanner_sock
+
+@gen.coroutine
+def check_devices_async(devices, io_loop=None):
+    """like check_devices, but the inquiry runs on the IOLoop so everything
+    else keeps running during the scan. Returns a Future with the names of
+    the missing devices."""
+    global scanner_sock
+    sock = get_scanner_sock()
+    try:
+        results = yield AsyncInquiry(sock, io_loop).start()
+    except Exception:
+        # Open the device again for the next scan
+        scanner_sock = None
+        sock.close()
+        raise
+    raise gen.Return(find_missing(devices, results))
+
 if __name__=="__main__":
     devices = [{'id': 0, 'mac': "5C:E8:EB:7B:87:45", 'name': 
 'ATeamKeys'},
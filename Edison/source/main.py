@@ -8,16 +8,17 @@ from logging.handlers import RotatingFileHandler
 import sys
 import signal
 import os
-import time
 from config_handler import config
 from daemon import Daemon
 from iot_client import IoTWebSocketClient, enqueue_message
+import compression
+import heartbeat
 from config_handler import config, prefs
 
 import pyupm_mma7660 as upmMMA7660
 import pyupm_buzzer as upmBuzzer
 import pyupm_grove as grove
-from libs.bluescan import check_devices
+from libs.bluescan import check_devices_async
 
 # global defines
 chords = [upmBuzzer.DO, upmBuzzer.RE, upmBuzzer.MI, upmBuzzer.FA,
@@ -30,6 +31,11 @@ y = upmMMA7660.new_intp()
 z = upmMMA7660.new_intp()
 xyz_thresh = 1
 SHAKE_THRESHOLD = 30
+# Samples in one shake window, taken 0.05 s apart
+SHAKE_SLOTS = 15
+
+# Future of the Bluetooth scan in progress, None while idle
+scan = None
 
 myBuzzer = None
 myDigitalAccelerometer = None
@@ -137,7 +143,17 @@ def setup_iot_client():
                                                      'host'),
                                           config.getint('backend',
                                                         'webport'))
-    backend_client = IoTWebSocketClient()
+    ping_interval, ping_timeout = heartbeat.ping_settings(config)
+    backend_client = IoTWebSocketClient(
+        codec=config.get('backend', 'codec'),
+        compression_options=compression.compression_options(config),
+        compression_min_size=config.getint('compression', 'min_size'),
+        ping_interval=ping_interval, ping_timeout=ping_timeout,
+        reconnect_delay=prefs.getfloat('timeouts', 'timeout_iot_retry'),
+        reconnect_max_delay=prefs.getfloat('timeouts',
+                                           'timeout_iot_retry_max'),
+        reconnect_jitter=prefs.getfloat('timeouts', 'iot_retry_jitter'),
+        reconnect_stable=prefs.getfloat('timeouts', 'timeout_iot_stable'))
     backend_client.connect(url=backend_url)
     return backend_client
 
@@ -163,62 +179,76 @@ def clear_lcd_screen(ioloop):
     if(myButton.value() == 1):
         print myButton.name(), ' value is ', myButton.value()
         clear_display(myLcd)
-    time.sleep(0.5)
     # Schedule next
-    callback_time = 0
-    ioloop.call_at(ioloop.time() + callback_time,
-                   clear_lcd_screen, ioloop)
+    ioloop.call_later(0.5, clear_lcd_screen, ioloop)
 
-def main_loop(ioloop, iot_client):
+def main_loop(ioloop, iot_client, shake_slot=0, xyz_count=0):
     '''
-    Main Loop
+    Main Loop, takes one accelerometer sample per call. A shake starts a
+    Bluetooth scan on the IOLoop, so sampling and the connection to the
+    backend keep running while it is in progress.
 
     :param ioloop:  Tornado ioloop instance
+    :param iot_client: IoTWebSocketClient
+    :param shake_slot: Sample within the current shake window
+    :param xyz_count: Samples above the threshold in the current window
     '''
-    devices = iot_client.getDevices()
-    chord_ind = 0
-    xyz_count = 0
-    # check shake for 5 sec
-    for shake_slot in range (0, 15):
-        myDigitalAccelerometer.getRawValues(x, y, z)
-        outputStr = ("Raw values: x = {0}"
-                     " y = {1}"
-                     " z = {2}").format(upmMMA7660.intp_value(x),
-                                        upmMMA7660.intp_value(y),
-                                        upmMMA7660.intp_value(z))
-        if (abs(upmMMA7660.intp_value(x)) > SHAKE_THRESHOLD) or \
-                (abs(upmMMA7660.intp_value(y)) > SHAKE_THRESHOLD) or \
-                (abs(upmMMA7660.intp_value(z)) > SHAKE_THRESHOLD):
-            print "value exceeded"
-            print xyz_count
-            xyz_count = xyz_count + 1
-            if (xyz_count >= xyz_thresh):
-                print "increasing thresh"
-                missing_devices = check_devices(devices)
-                if len(missing_devices) > 0:
-                    print "Missing devices"+"\n"
-                    print missing_devices
-                    for chord_ind in range (0,15):
-                        print myBuzzer.playSound(chords[chord_ind], 100000)
-                        print "buzzing"
-                        #time.sleep(0.1)
-                        chord_ind += 1
-                    data = create_message('Alert!', 'Missing item', True,
-                                      '10.10.40.3')
-                    enqueue_message(data)
-                myBuzzer.stopSound()
-                xyz_count = 0
-                print outputStr
-        time.sleep(0.05)
-    print "loop over"
-    xyz_count = 0
+    global scan
+    myDigitalAccelerometer.getRawValues(x, y, z)
+    outputStr = ("Raw values: x = {0}"
+                 " y = {1}"
+                 " z = {2}").format(upmMMA7660.intp_value(x),
+                                    upmMMA7660.intp_value(y),
+                                    upmMMA7660.intp_value(z))
+    if (abs(upmMMA7660.intp_value(x)) > SHAKE_THRESHOLD) or \
+            (abs(upmMMA7660.intp_value(y)) > SHAKE_THRESHOLD) or \
+            (abs(upmMMA7660.intp_value(z)) > SHAKE_THRESHOLD):
+        print "value exceeded"
+        print xyz_count
+        xyz_count = xyz_count + 1
+        if (xyz_count >= xyz_thresh):
+            print "increasing thresh"
+            # Shakes during a scan are covered by that scan
+            if scan is None:
+                scan = check_devices_async(iot_client.getDevices(), ioloop)
+                ioloop.add_future(scan, on_scan_done)
+            xyz_count = 0
+            print outputStr
+    shake_slot += 1
+    if shake_slot == SHAKE_SLOTS:
+        print "loop over"
+        shake_slot = 0
+        xyz_count = 0
 
     # Schedule next
-    callback_time = 0
-    ioloop.call_at(ioloop.time() + callback_time,
-                   main_loop, ioloop, iot_client)
+    ioloop.call_later(0.05, main_loop, ioloop, iot_client, shake_slot,
+                      xyz_count)
     return
 
+def on_scan_done(future):
+    '''
+    Alert when the scan started by a shake found devices missing.
+
+    :param future: Future of check_devices_async
+    '''
+    global scan
+    scan = None
+    try:
+        missing_devices = future.result()
+    except Exception as e:
+        logging.error("Bluetooth scan failed: %s" % e)
+        return
+    if len(missing_devices) > 0:
+        print "Missing devices"+"\n"
+        print missing_devices
+        for chord_ind in range (0,15):
+            print myBuzzer.playSound(chords[chord_ind], 100000)
+            print "buzzing"
+        data = create_message('Alert!', 'Missing item', True,
+                              '10.10.40.3')
+        enqueue_message(data)
+    myBuzzer.stopSound()
+
 def create_message(line1, line2, is_error, target):
     msg = {'line1': line1,
            'line2': line2,
@@ -0,0 +1,87 @@
+import json
+import logging
+import sqlite3
+import time
+
+
+class MessageStore:
+    '''
+    Append-only log of outgoing messages in a SQLite database, so messages
+    waiting for the backend survive a restart. The database runs in WAL mode
+    with synchronous=NORMAL: an append is one small write to the log without
+    an fsync, and the log is checkpointed in the background by SQLite.
+
+    Rows are removed once the backend acknowledged them, or when they are
+    dropped for the size limit or expired.
+    '''
+    def __init__(self, path):
+        '''
+        Open or create the store
+
+        :param path: Database file
+        :return: None
+        '''
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'created REAL NOT NULL, '
+                        'message TEXT NOT NULL)')
+
+    def append(self, message, created=None):
+        '''
+        Store a message.
+
+        :param message: Message, anything JSON can encode
+        :param created: Time the message was created, now if None
+        :return: (id, created) of the stored message
+        '''
+        if created is None:
+            created = time.time()
+        cursor = self.db.execute(
+            'INSERT INTO outbox (created, message) VALUES (?, ?)',
+            (created, json.dumps(message)))
+        return cursor.lastrowid, created
+
+    def load(self, limit):
+        '''
+        Read the newest stored messages, oldest first.
+
+        :param limit: Maximum number of messages
+        :return: List of (id, created, message)
+        '''
+        rows = self.db.execute(
+            'SELECT id, created, message FROM outbox '
+            'ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        messages = []
+        for message_id, created, message in reversed(rows):
+            try:
+                messages.append((message_id, created, json.loads(message)))
+            except ValueError:
+                logging.warning('Skipping unreadable stored message %d' %
+                                message_id)
+        return messages
+
+    def remove_through(self, message_id):
+        '''
+        Remove a message and all messages stored before it.
+
+        :param message_id: Id of the last message to remove
+        :return: None
+        '''
+        self.db.execute('DELETE FROM outbox WHERE id <= ?', (message_id,))
+
+    def remove(self, message_ids):
+        '''
+        Remove messages.
+
+        :param message_ids: Ids of the messages
+        :return: None
+        '''
+        self.db.executemany('DELETE FROM outbox WHERE id = ?',
+                            [(message_id,) for message_id in message_ids])
+
+    def close(self):
+        self.db.close()
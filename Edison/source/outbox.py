@@ -0,0 +1,292 @@
+import collections
+import logging
+import time
+from tornado import ioloop
+from tornado import iostream
+from tornado import websocket
+from message_store import MessageStore
+
+
+class Outbox:
+    '''
+    Messages waiting to be sent to the backend. Any thread may put a message,
+    it is handed to the IOLoop with add_callback, the only thread safe IOLoop
+    method. On the IOLoop the waiting messages are sent in batches while a
+    sender is attached, i.e. while connected, and kept while not.
+
+    A sent message is kept until the backend acknowledges or answers its
+    msgid, see acknowledge. The messages still unacknowledged when the
+    connection is lost are sent again after the next attach, so a message
+    may arrive twice but is not lost. A message the backend throttled is
+    sent again after the retry_after of its error, see throttled.
+
+    With a MessageStore every message is also written to disk, and the
+    backlog of a previous run is loaded again on start. Messages older than
+    max_age seconds are dropped instead of sent.
+
+    Nothing polls: a batch is only scheduled when a message arrives or a
+    connection attaches. After a batch the next one follows batch_interval
+    seconds later, so replaying a long backlog stays within the inbound
+    rate limit of the backend and other IOLoop work runs in between.
+    '''
+    def __init__(self, max_size=1000, batch_size=50, batch_interval=0,
+                 max_age=0, store=None, io_loop=None):
+        '''
+        Create an outbox, with the backlog of the store if any
+
+        :param max_size: Maximum number of waiting and unacknowledged
+         messages, the oldest is dropped beyond that
+        :param batch_size: Messages sent at once
+        :param batch_interval: Seconds between two batches
+        :param max_age: Seconds after which a waiting message is dropped, 0
+         to keep messages until sent
+        :param store: MessageStore, None to keep messages in memory only
+        :param io_loop: IOLoop, the global instance if None
+        :return: None
+        '''
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_age = max_age
+        self.store = store
+        self.io_loop = io_loop
+        # Waiting messages as (store id, creation time, message)
+        self.messages = collections.deque()
+        # Sent messages per msgid until acknowledged, in the order they were
+        # sent
+        self.unacked = collections.OrderedDict()
+        # Function sending a list of messages, returning their msgids or None
+        # if it could not
+        self.sender = None
+        self.drain_scheduled = False
+        # No batches before this time, after the backend throttled one
+        self.paused_until = 0
+        # Counters
+        self.sent = 0
+        self.acked = 0
+        self.resent = 0
+        self.dropped = 0
+        self.expired = 0
+        if store is not None:
+            self.messages.extend(store.load(max_size))
+            # Anything older did not fit anymore
+            if self.messages:
+                store.remove_through(self.messages[0][0] - 1)
+            logging.info('Outbox: %d stored messages loaded' %
+                         len(self.messages))
+
+    def get_io_loop(self):
+        return self.io_loop or ioloop.IOLoop.instance()
+
+    def put(self, message):
+        '''
+        Add a message. Safe to call from any thread.
+
+        :param message: Message
+        :return: None
+        '''
+        self.get_io_loop().add_callback(self.append, message)
+
+    def append(self, message):
+        if len(self.messages) + len(self.unacked) >= self.max_size:
+            self.drop_oldest()
+        if self.store is not None:
+            message_id, created = self.store.append(message)
+        else:
+            message_id, created = None, time.time()
+        self.messages.append((message_id, created, message))
+        self.schedule_drain()
+
+    def drop_oldest(self):
+        '''
+        Drop the oldest message to make room, an unacknowledged one if there
+        are any.
+
+        :return: None
+        '''
+        if self.unacked:
+            self.forget([self.unacked.popitem(last=False)[1]])
+        else:
+            self.remove(1)
+        self.dropped += 1
+
+    def remove(self, count):
+        '''
+        Remove waiting messages from the front, and from the store.
+
+        :param count: Number of messages
+        :return: None
+        '''
+        self.forget([self.messages.popleft() for i in range(count)])
+
+    def forget(self, entries):
+        '''
+        Remove messages that left the outbox from the store.
+
+        :param entries: List of (store id, creation time, message)
+        :return: None
+        '''
+        if self.store is not None and entries:
+            self.store.remove([entry[0] for entry in entries])
+
+    def expire(self):
+        '''
+        Drop the messages older than max_age.
+
+        :return: None
+        '''
+        if not self.max_age:
+            return
+        oldest = time.time() - self.max_age
+        count = 0
+        for message_id, created, message in self.messages:
+            if created >= oldest:
+                break
+            count += 1
+        if count:
+            self.remove(count)
+            self.expired += count
+            logging.warning('Outbox: %d messages expired' % count)
+
+    def acknowledge(self, msgid):
+        '''
+        Forget a sent message, after the backend acknowledged or answered it.
+
+        :param msgid: Message id it was sent with
+        :return: False if no message was waiting for it, True otherwise
+        '''
+        entry = self.unacked.pop(msgid, None)
+        if entry is None:
+            return False
+        self.forget([entry])
+        self.acked += 1
+        return True
+
+    def throttled(self, msgid, retry_after):
+        '''
+        Send a message again that the backend dropped because of its inbound
+        rate limit, after retry_after seconds. The backend drops the rest of
+        the frame too, and the frames it receives while throttled, so every
+        message sent after it goes back as well.
+
+        :param msgid: Message id of the throttled message
+        :param retry_after: Seconds until the backend accepts messages again
+        :return: None
+        '''
+        if msgid not in self.unacked:
+            return
+        msgids = list(self.unacked)
+        self.requeue(msgids[msgids.index(msgid):])
+        self.paused_until = time.time() + retry_after
+        self.schedule_drain(retry_after)
+
+    def requeue(self, msgids):
+        '''
+        Put sent messages back in front of the waiting ones, in the order
+        they were sent.
+
+        :param msgids: Message ids, in the order they were sent
+        :return: None
+        '''
+        entries = [self.unacked.pop(msgid) for msgid in msgids]
+        self.messages.extendleft(reversed(entries))
+        self.resent += len(entries)
+
+    def attach(self, sender):
+        '''
+        Start sending, after connecting.
+
+        :param sender: Function sending a list of messages, returning their
+         msgids or None if they could not be sent
+        :return: None
+        '''
+        self.sender = sender
+        self.schedule_drain()
+
+    def detach(self):
+        '''
+        Stop sending after the connection was lost, and keep the messages.
+        The unacknowledged ones are sent again after the next attach.
+
+        :return: None
+        '''
+        self.sender = None
+        if self.unacked:
+            logging.info('Outbox: %d messages not acknowledged, sending ' %
+                         len(self.unacked) + 'them again after reconnecting')
+            self.requeue(list(self.unacked))
+
+    def schedule_drain(self, delay=0):
+        if self.sender is not None and self.messages and \
+                not self.drain_scheduled:
+            self.drain_scheduled = True
+            if delay:
+                self.get_io_loop().call_later(delay, self.drain)
+            else:
+                self.get_io_loop().add_callback(self.drain)
+
+    def drain(self):
+        '''
+        Send a batch of waiting messages at once. If it could not be sent,
+        the messages are kept and sending stops until the next attach.
+
+        :return: None
+        '''
+        self.drain_scheduled = False
+        if self.sender is None:
+            return
+        pause = self.paused_until - time.time()
+        if pause > 0:
+            self.schedule_drain(pause)
+            return
+        self.expire()
+        if not self.messages:
+            return
+        count = min(self.batch_size, len(self.messages))
+        batch = [self.messages[i][2] for i in range(count)]
+        try:
+            msgids = self.sender(batch)
+        except (websocket.WebSocketClosedError,
+                iostream.StreamClosedError):
+            msgids = None
+        except Exception:
+            # Would fail again, do not block the messages behind it
+            logging.exception('Dropping %d messages from the outbox' % count)
+            self.remove(count)
+            self.dropped += count
+            self.schedule_drain()
+            return
+        if not msgids:
+            self.detach()
+            return
+        for msgid in msgids:
+            self.unacked[msgid] = self.messages.popleft()
+        self.sent += count
+        self.schedule_drain(self.batch_interval)
+
+    def as_dict(self):
+        return {'waiting': len(self.messages),
+                'unacked': len(self.unacked),
+                'sent': self.sent,
+                'acked': self.acked,
+                'resent': self.resent,
+                'dropped': self.dropped,
+                'expired': self.expired}
+
+
+def create_outbox(config):
+    '''
+    Create an outbox with the settings of the [outbox] section.
+
+    :param config: Configuration
+    :return: Outbox
+    '''
+    store = None
+    path = config.get('outbox', 'path')
+    if path:
+        store = MessageStore(path)
+    return Outbox(max_size=config.getint('outbox', 'max_size'),
+                  batch_size=config.getint('outbox', 'batch_size'),
+                  batch_interval=config.getfloat('outbox', 'batch_interval'),
+                  max_age=config.getfloat('outbox', 'max_age'),
+                  store=store)
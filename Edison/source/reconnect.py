@@ -0,0 +1,112 @@
+import random
+import time
+
+
+class Backoff:
+    '''
+    Delays between reconnect attempts. The delay doubles with every failed
+    attempt up to a maximum, and a random part of it is left out so clients
+    that lost the same backend do not all reconnect at the same moment.
+    '''
+    def __init__(self, initial, maximum, jitter=0.5, multiplier=2.0):
+        '''
+        Create the backoff
+
+        :param initial: Seconds before the first attempt
+        :param maximum: Maximum seconds between attempts
+        :param jitter: Fraction of each delay that is randomized, 0 for
+         fixed delays
+        :param multiplier: Growth of the delay per failed attempt
+        :return: None
+        '''
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.multiplier = multiplier
+        self.failures = 0
+
+    def next_delay(self):
+        '''
+        Get the delay before the next attempt, and count the attempt.
+
+        :return: Seconds
+        '''
+        delay = min(self.maximum,
+                    self.initial * self.multiplier ** self.failures)
+        if delay < self.maximum:
+            self.failures += 1
+        return delay * (1 - self.jitter) + random.uniform(0,
+                                                          delay * self.jitter)
+
+    def reset(self):
+        '''
+        Start from the initial delay again, after a connection stayed up.
+
+        :return: None
+        '''
+        self.failures = 0
+
+
+class ConnectionStats:
+    '''
+    Counts the connect attempts to the backend and measures the outages,
+    from losing the connection (or failing the first attempt) until it is
+    back.
+    '''
+    def __init__(self):
+        self.attempts = 0
+        self.failed_attempts = 0
+        self.outages = 0
+        self.outage_started = None
+        self.last_outage = None
+        self.longest_outage = 0.0
+        self.total_outage = 0.0
+
+    def attempt(self):
+        self.attempts += 1
+
+    def failed(self):
+        self.failed_attempts += 1
+        self.disconnected()
+
+    def disconnected(self):
+        '''
+        Start an outage, unless one is going on already.
+
+        :return: None
+        '''
+        if self.outage_started is None:
+            self.outage_started = time.time()
+            self.outages += 1
+
+    def connected(self):
+        '''
+        End the current outage, if any.
+
+        :return: Seconds the outage lasted, or None if there was none
+        '''
+        if self.outage_started is None:
+            return None
+        duration = time.time() - self.outage_started
+        self.outage_started = None
+        self.last_outage = duration
+        self.longest_outage = max(self.longest_outage, duration)
+        self.total_outage += duration
+        return duration
+
+    def as_dict(self):
+        '''
+        Get the counters, including the current outage.
+
+        :return: Dict with the counters, durations in seconds
+        '''
+        current = None
+        if self.outage_started is not None:
+            current = time.time() - self.outage_started
+        return {'attempts': self.attempts,
+                'failed_attempts': self.failed_attempts,
+                'outages': self.outages,
+                'current_outage': current,
+                'last_outage': self.last_outage,
+                'longest_outage': self.longest_outage,
+                'total_outage': self.total_outage}